@@ -1,11 +1,331 @@
-from scipy.optimize import differential_evolution
+from scipy.optimize import differential_evolution, minimize, least_squares, OptimizeResult
+from scipy.interpolate import PchipInterpolator, CubicSpline
 import numpy as np
 import pandas as pd
-import os, sys
-from collections import defaultdict
+import os
+import re
+import shutil
+import math
+import contextlib
+import copy
+import functools
+import hashlib
+import itertools
+import threading
+import time
+import json
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numba
+except ImportError:  # the Rs kernels fall back to plain NumPy
+    numba = None
+
+
+def _squeeze(value):
+    # keep the scalar-in/scalar-out behaviour of the correlations when they are
+    # evaluated with np.where on scalar inputs
+    if isinstance(value, np.ndarray) and value.ndim == 0:
+        return value[()]
+    return value
+
+
+def _write_columnar_cache(df, cache_path):
+    # one .npy file per column plus a manifest, written to a temporary folder first so a
+    # half written cache is never picked up. The temporary folder is removed when anything fails,
+    # e.g. another process having written the same cache first (os.replace onto a non-empty folder).
+    tmp_path = cache_path + '.tmp%d' % os.getpid()
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        columns = []
+        for i, column in enumerate(df.columns):
+            values = df[column].to_numpy()
+            np.save(os.path.join(tmp_path, '%d.npy' % i), values, allow_pickle=values.dtype == object)
+            columns.append(str(column))
+        with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+            json.dump(columns, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def _remove_stale_caches(cache_dir, filename, file_key):
+    # removes the finished caches of older versions of filename, i.e. entries whose file part of
+    # the name differs from file_key; caches of the same file under other settings and temporary
+    # folders of writers still running are left alone
+    pattern = re.compile(re.escape(filename) + r'-([0-9a-f]{16})-[0-9a-f]{16}')
+    for entry in os.listdir(cache_dir):
+        match = pattern.fullmatch(entry)
+        if match and match.group(1) != file_key:
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+
+def _read_columnar_cache(cache_path):
+    # numeric columns are memory mapped copy-on-write, object (text) columns are loaded
+    with open(os.path.join(cache_path, 'columns.json')) as f:
+        columns = json.load(f)
+    data = {}
+    for i, column in enumerate(columns):
+        filename = os.path.join(cache_path, '%d.npy' % i)
+        try:
+            data[column] = np.load(filename, mmap_mode='c')
+        except ValueError:
+            data[column] = np.load(filename, allow_pickle=True)
+    return pd.DataFrame(data, copy=False)
+
+
+def _iter_table_chunks(source, chunksize):
+    # DataFrames of at most chunksize rows from a CSV/Parquet path, a DataFrame or an
+    # iterable of DataFrames
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunksize):
+            yield source.iloc[start:start + chunksize]
+    elif isinstance(source, str) and source.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif isinstance(source, str):
+        with pd.read_csv(source, chunksize=chunksize) as reader:
+            for chunk in reader:
+                yield chunk
+    else:
+        for chunk in source:
+            yield chunk
+
+
+def _append_table_chunk(df, output, writer=None, first=False):
+    # appends df to a .csv or .parquet file; returns the parquet writer to reuse for the next chunk
+    if output.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(output, table.schema)
+        writer.write_table(table)
+        return writer
+    df.to_csv(output, mode='w' if first else 'a', header=first, index=False)
+    return writer
+
+
+def _match_PVT_table(args):
+    # worker of PVTCORR.match_PVT_tables, kept at module level so it can be pickled
+    pvtcorr, sample, range_of_values, seed, vectorized, method = args
+    res = pvtcorr._matchPVT(range_of_values, seed=seed, vectorized=vectorized, method=method)
+    return {'sample': sample,
+            'api': res.x[0],
+            'gas_gravity': res.x[1],
+            'temperature': res.x[2],
+            'objective': res.fun,
+            'success': res.success,
+            'nit': res.nit,
+            'nfev': res.nfev,
+            'seed': seed,
+            'message': res.message}
+
+
+class PVTCache:
+    # Bounded LRU cache of correlation results, keyed on the method name and its inputs rounded
+    # to `digits` significant digits. Only calls with scalar inputs are cached; array calls are
+    # passed through. Safe to share between threads.
+    def __init__(self, maxsize=100000, digits=10):
+        self.maxsize = maxsize
+        self.digits = digits
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def scalar_inputs(args, kwargs):
+        # False as soon as one input is an array, before anything is formatted
+        return all(value is None or isinstance(value, (float, int, str)) or np.ndim(value) == 0
+                   for value in itertools.chain(args, kwargs.values()))
+
+    def key(self, name, args, kwargs):
+        # None when any input is not a scalar
+        if not self.scalar_inputs(args, kwargs):
+            return None
+        key = [name]
+        for value in itertools.chain(args, sorted(kwargs.items())):
+            if isinstance(value, tuple):  # keyword argument
+                key.append(value[0])
+                value = value[1]
+            if value is None or isinstance(value, str):
+                key.append(value)
+            else:
+                key.append(float('%.*g' % (self.digits, value)))
+        return tuple(key)
+
+    def bypassed(self):
+        # True while this thread evaluates the matching objective
+        return getattr(self._local, 'bypassed', False)
+
+    @contextlib.contextmanager
+    def bypass(self):
+        # the property methods called inside are not looked up, see _cached_method
+        previous = self.bypassed()
+        self._local.bypassed = True
+        try:
+            yield
+        finally:
+            self._local.bypassed = previous
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+def _cached_method(pvtcorr, name):
+    # wraps the bound method `name` of pvtcorr with its PVTCache; the instance settings the
+    # correlations read (saturation pressure, separator conditions, salinity, fixed Z-factor
+    # iterations) are part of the key. The matching objective _optimizer is keyed on the rounded
+    # candidate X and the version of the measured table; populations (2-D X) are not cached.
+    # The objective evaluates the properties on arrays, so the property wrappers are bypassed
+    # inside it and only _optimizer is memoized during matching.
+    method = getattr(type(pvtcorr), name).__get__(pvtcorr)
+    cache = pvtcorr._cache
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if name == '_optimizer':
+            X = np.asarray(args[0])
+            if X.ndim != 1:
+                with cache.bypass():
+                    return method(*args, **kwargs)
+            pvtcorr._getPVTArrays()  # brings _pvt_arrays_version up to date
+            settings = (pvtcorr.sat_pressure, pvtcorr.Tsp, pvtcorr.Psp, pvtcorr.Salinity, pvtcorr.zFactorIterations)
+            key = cache.key(name, settings + (pvtcorr._pvt_arrays_version,) + tuple(X.tolist()), {})
+        elif cache.bypassed() or not cache.scalar_inputs(args, kwargs):
+            return method(*args, **kwargs)
+        else:
+            settings = (pvtcorr.sat_pressure, pvtcorr.Tsp, pvtcorr.Psp, pvtcorr.Salinity, pvtcorr.zFactorIterations)
+            key = cache.key(name, settings + args, kwargs)
+        try:
+            return cache.get(key)
+        except KeyError:
+            with cache.bypass():
+                value = method(*args, **kwargs)
+            cache.put(key, value)
+            return value
+
+    return wrapper
+
+
+class PVTProfile:
+    # Counters filled by PVTCORR.enable_profiling: calls and cumulative wall time of every profiled
+    # method (inclusive, so computeDryGasFVF also counts the Z-factor it triggers), a histogram of
+    # the Newton iterations of every Z-factor point, and the number of objective evaluations
+    # (candidates scored, a vectorized population counts every member).
+    def __init__(self, iter_max=100):
+        self.calls = {}
+        self.time = {}
+        self.zfactor_iterations = np.zeros(iter_max + 1, dtype=int)
+        self.objective_evaluations = 0
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.time[name] = self.time.get(name, 0.) + elapsed
+
+    def record_zfactor(self, iters):
+        # the histogram grows when a fixed number of Newton steps (zFactorIterations) exceeds its size
+        counts = np.bincount(np.ravel(iters), minlength=self.zfactor_iterations.size)
+        with self._lock:
+            if counts.size > self.zfactor_iterations.size:
+                self.zfactor_iterations = np.concatenate(
+                    [self.zfactor_iterations, np.zeros(counts.size - self.zfactor_iterations.size, dtype=int)])
+            self.zfactor_iterations[:counts.size] += counts
+
+    def record_objective(self, n_candidates):
+        with self._lock:
+            self.objective_evaluations += n_candidates
+
+    def clear(self):
+        with self._lock:
+            self.calls.clear()
+            self.time.clear()
+            self.zfactor_iterations[:] = 0
+            self.objective_evaluations = 0
+
+    def stats(self):
+        # calls and time per method as a DataFrame sorted by time, plus the Z-factor and objective counters
+        methods = pd.DataFrame({'calls': pd.Series(self.calls, dtype=int), 'time': pd.Series(self.time, dtype=float)})
+        methods['time_per_call'] = methods['time'] / methods['calls']
+        return {'methods': methods.sort_values('time', ascending=False),
+                'zfactor_iterations': self.zfactor_iterations.copy(),
+                'zfactor_points': int(self.zfactor_iterations.sum()),
+                'objective_evaluations': self.objective_evaluations}
+
+
+def _profiled_method(pvtcorr, name):
+    # wraps the current pvtcorr.name (the cache wrapper when the cache is enabled) with the
+    # counters of its PVTProfile
+    method = getattr(pvtcorr, name)
+    profile = pvtcorr._profile
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        value = method(*args, **kwargs)
+        profile.record(name, time.perf_counter() - start)
+        if name == 'solveDryGasZFactor':
+            profile.record_zfactor(value[1])
+        elif name == '_objective':
+            profile.record_objective(np.size(value))
+        return value
+
+    return wrapper
 
 
 class PVTCORR:
+    # measured columns of pvt_table used for matching, besides the pressure 'p'
+    PVT_PROPERTIES = ('Rgo', 'Bo', 'Bg', 'Bw', 'visc_o', 'visc_g', 'visc_w')
+    # property methods memoized by enable_cache
+    CACHED_METHODS = ('_computeSolutionGasOilRatio', '_computeLiveOilFVF',
+                      '_computeIsothermalLiveOilCompressibilityAbovePsat', 'computeLiveOilViscosity',
+                      'computeDeadOilViscosity', 'computeDryGasFVF', 'computeDryGasZFactor',
+                      'computeDryGasViscosity', 'computeDryGasDensity', 'computeWaterFVF',
+                      'computeIsothermalWaterCompressiblity', 'computerWaterViscosity', '_optimizer')
+    # methods counted by enable_profiling
+    PROFILED_METHODS = CACHED_METHODS + ('solveDryGasZFactor', '_getPVTArrays', '_residuals', '_objective')
+    # range of the pseudo reduced temperature and pressure of the Dranchuk-Abou-Kassem Z-factor;
+    # the Ppr range is only reported, as in the original correlation checks
+    ZFACTOR_TPR_RANGE = (1.0, 3.0)
+    ZFACTOR_PPR_RANGE = (0.2, 30.0)
+    # A1 to A11 of Dranchuk and Abou-Kassem (1975)
+    DAK_COEFFICIENTS = (0.3265, -1.0700, -0.5339, 0.01569, -0.05165, 0.5475, -0.7361, 0.1844, 0.1056, 0.6134,
+                        0.7210)
+
     def __init__(self, sat_pressure, Tsp, Psp):
         self.sat_pressure = sat_pressure
         self.Tsp = Tsp
@@ -14,15 +334,67 @@ class PVTCORR:
         self.LARGE = 1e+12
         self.TINY = 1e-12
         self.iterMax = 100
+        self.zFactorIterations = None  # fixed Newton steps of the Z-factor, None stops on TINY
         self.Pstd = 14.69
         self.Tstd = 60
         self.AirMolecularWt = 28.96
+        self._pvt_arrays = None
+        self._pvt_arrays_source = None
+        self._pvt_arrays_version = 0
+        self._match_state = {}
+        self._cache = None
+        self._profile = None
 
         # if not os.path.exists(filepath):
         #     print('PVT file does not exist:%s' % (filepath))
         #     sys.exit(1)
         # self.pvt_table = pd.read_csv(filepath)
 
+    def enable_cache(self, maxsize=100000, digits=10):
+        # Memoizes the scalar calls of the property methods (CACHED_METHODS) in a bounded LRU
+        # cache; the wrappers live on the instance, so nothing is paid while it is disabled.
+        # The matching only evaluates the properties on arrays, so for it the cache works at the
+        # level of the objective: single candidates revisited by differential evolution,
+        # L-BFGS-B or rematch_PVT_values are served from the cache.
+        # Returns the PVTCache, whose stats() report hits, misses and evictions.
+        self.disable_cache()
+        self._cache = PVTCache(maxsize=maxsize, digits=digits)
+        for name in self.CACHED_METHODS:
+            setattr(self, name, _cached_method(self, name))
+        return self._cache
+
+    def disable_cache(self):
+        for name in self.CACHED_METHODS:
+            self.__dict__.pop(name, None)
+        self._cache = None
+
+    def enable_profiling(self):
+        # Counts calls, time, Z-factor iterations and objective evaluations (see PVTProfile) by
+        # wrapping PROFILED_METHODS on the instance, so nothing is paid while it is disabled.
+        # Enable the cache first when both are wanted. Returns the PVTProfile.
+        self.disable_profiling()
+        self._profile = PVTProfile(iter_max=self.iterMax)
+        for name in self.PROFILED_METHODS:
+            setattr(self, name, _profiled_method(self, name))
+        return self._profile
+
+    def disable_profiling(self):
+        for name in self.PROFILED_METHODS:
+            self.__dict__.pop(name, None)
+        self._profile = None
+        if self._cache is not None:  # the cache wrappers were replaced by the profiled ones
+            for name in self.CACHED_METHODS:
+                setattr(self, name, _cached_method(self, name))
+
+    @contextlib.contextmanager
+    def profile(self):
+        # with pvtcorr.profile() as profile: ... ; profile.stats() stays readable afterwards
+        profile = self.enable_profiling()
+        try:
+            yield profile
+        finally:
+            self.disable_profiling()
+
     def _computeGasGravityAtSeparatorConditions(self, Gamma, API):
         # what is this?
         # page 60 of https://ntnuopen.ntnu.no/ntnu-xmlui/bitstream/handle/11250/2397728/15177_FULLTEXT.pdf?sequence=1
@@ -31,49 +403,47 @@ class PVTCORR:
         return Gamma_gs
 
     def _computeIsothermalLiveOilCompressibilityAbovePsat(self, api, temperature,
-                                                          pressure, gas_gravity):
+                                                          pressure, gas_gravity, sat_pressure=None, GOR=None):
+        # GOR: solution gas oil ratio at Psat, if it has already been computed
+        Psat = self.sat_pressure if sat_pressure is None else sat_pressure
         Tres = temperature
         API = api
         Gamma_gs = self._computeGasGravityAtSeparatorConditions(gas_gravity, API)
-        GOR = self._computeSolutionGasOilRatio(api, temperature, self.sat_pressure,
-                                               gas_gravity)
+        if GOR is None:
+            GOR = self._computeSolutionGasOilRatio(api, temperature, Psat,
+                                                   gas_gravity, sat_pressure=Psat)
         Co = (-1433.0 + 5.0 * GOR + 17.2 * Tres - 1180.0 * Gamma_gs
               + 12.61 * API) / (pressure * 1e+5)
         return Co
 
     def _computeSolutionGasOilRatio(self, api, temperature,
-                                    pressure, gas_gravity):
+                                    pressure, gas_gravity, sat_pressure=None):
         # Vazquez and Beggs, 1980 (Default in EMPower)
-        C1 = 0.0362
-        C2 = 1.0937
-        C3 = 25.7240
-        if (api > (30.0 + 1e-12)):
-            C1 = 0.0178
-            C2 = 1.1870
-            C3 = 23.9310
-        Psat = self.sat_pressure
+        # api, temperature, pressure, gas_gravity and sat_pressure may be scalars or arrays
+        light = np.greater(api, 30.0 + 1e-12)
+        C1 = np.where(light, 0.0178, 0.0362)
+        C2 = np.where(light, 1.1870, 1.0937)
+        C3 = np.where(light, 23.9310, 25.7240)
+        Psat = self.sat_pressure if sat_pressure is None else sat_pressure
         Tsat = temperature
         API = api
         Gamma_gs = self._computeGasGravityAtSeparatorConditions(gas_gravity, API)
         a = C1 * Gamma_gs
         c = np.exp(C3 * API / (Tsat + 459.67))
-        if pressure <= Psat:
-            temp = a * (np.power(pressure, C2)) * c
-        else:
-            temp = a * (np.power(self.sat_pressure, C2)) * c
-        return temp
+        # Rs stays at its saturation value above Psat
+        temp = a * (np.power(np.minimum(pressure, Psat), C2)) * c
+        return _squeeze(temp)
 
-    def _computeLiveOilFVF(self, api, temperature, pressure, gas_gravity):
+    def _computeLiveOilFVF(self, api, temperature, pressure, gas_gravity, sat_pressure=None,
+                           Rso=None, Rso_sat=None):
         # Vasquez and Beggs?
-        C1 = 4.677e-4
-        C2 = 1.751e-5
-        C3 = -1.811e-8
-        if (api > (30.0 + 1e-12)):
-            C1 = 4.670e-4
-            C2 = 1.100e-5
-            C3 = 1.337e-9
-
-        Psat = self.sat_pressure
+        # Rso, Rso_sat: solution gas oil ratio at pressure and at Psat, if already computed
+        light = np.greater(api, 30.0 + 1e-12)
+        C1 = np.where(light, 4.670e-4, 4.677e-4)
+        C2 = np.where(light, 1.100e-5, 1.751e-5)
+        C3 = np.where(light, 1.337e-9, -1.811e-8)
+
+        Psat = self.sat_pressure if sat_pressure is None else sat_pressure
         Tres = temperature
         API = api
         Gamma_gs = self._computeGasGravityAtSeparatorConditions(gas_gravity, API)
@@ -81,28 +451,24 @@ class PVTCORR:
         C1 = C1 * 1.0
         C2 = C2 * (Tres - 60) * (API / Gamma_gs)
         C3 = C3 * (Tres - 60) * (API / Gamma_gs)
-        Rso = self._computeSolutionGasOilRatio(api, temperature, pressure,
-                                               gas_gravity)
-        if pressure <= Psat:
-            temp = 1.0 + C1 * Rso + C2 + C3 * Rso
-        else:
-            Co = self._computeIsothermalLiveOilCompressibilityAbovePsat(api,
-                                                                        temperature, pressure, gas_gravity)
-            # print(Co)
-            Rso_sat = self._computeSolutionGasOilRatio(api, temperature,
-                                                       self.sat_pressure,
-                                                       gas_gravity)
-            # print(Rso_sat)
-            Bo_sat = 1.0 + C1 * Rso_sat + C2 + C3 * Rso_sat
-            # print(Bo_sat)
-            temp = Bo_sat * np.exp(-Co * (pressure - Psat))
-        return temp
-
-    def computeLiveOilViscosity(self, api, temperature, pressure, gas_gravity):
+        if Rso is None:
+            Rso = self._computeSolutionGasOilRatio(api, temperature, pressure,
+                                                   gas_gravity, sat_pressure=Psat)
+        # Rso is capped at Rso(Psat), so above Psat this is already Bo at saturation
+        Bo = 1.0 + C1 * Rso + C2 + C3 * Rso
+        Co = self._computeIsothermalLiveOilCompressibilityAbovePsat(api,
+                                                                    temperature, pressure, gas_gravity,
+                                                                    sat_pressure=Psat, GOR=Rso_sat)
+        temp = np.where(pressure <= Psat, Bo, Bo * np.exp(-Co * (pressure - Psat)))
+        return _squeeze(temp)
+
+    def computeLiveOilViscosity(self, api, temperature, pressure, gas_gravity, sat_pressure=None, Rso=None):
 
         # Beggs and Robinson, 1975 Defailt EMPower
-        Rso = self._computeSolutionGasOilRatio(api, temperature, pressure,
-                                               gas_gravity)
+        Psat = self.sat_pressure if sat_pressure is None else sat_pressure
+        if Rso is None:
+            Rso = self._computeSolutionGasOilRatio(api, temperature, pressure,
+                                                   gas_gravity, sat_pressure=Psat)
         Visc_oil = self.computeDeadOilViscosity(api, temperature)
         a = 10.715 * ((Rso + 100.0) ** (-0.515))
         b = 5.44 * ((Rso + 150.0) ** (-0.338))
@@ -130,72 +496,176 @@ class PVTCORR:
         Visc_oil = 10 ** a - 1
         return Visc_oil
 
-    def computeDryGasFVF(self, pressure, temperature, gas_gravity):
+    def computeDryGasFVF(self, pressure, temperature, gas_gravity, Zfactor=None):
 
-        self.computeDryGasZFactor(pressure, gas_gravity, temperature)
+        if Zfactor is None:
+            Zfactor = self.computeDryGasZFactor(pressure, gas_gravity, temperature)
         Tres = temperature
         fac = self.Pstd / (self.Tstd + 459.67)  # use this fro ft3/scf
         fac = fac * 0.178107607  # conversion factor for cubic feet to bbl for us crude oil
         # http://www.asknumbers.com/CubicFeetToBarrel.aspx
-        Bg = fac * self.Zfactor * (Tres + 459.67) / pressure
+        Bg = fac * Zfactor * (Tres + 459.67) / pressure
         return Bg
 
     def computeDryGasZFactor(self, pressure, gas_gravity, temperature):
+        Zr, iters, converged = self.solveDryGasZFactor(pressure, gas_gravity, temperature)
+        return Zr
 
-        # Dranchuk and Abou-Kassem, 1975-Default EMPower
-        Zr = 1.0
-        Zfactor = Zr
-        A1 = 0.3265
-        A2 = -1.0700
-        A3 = -0.5339
-        A4 = 0.01569
-        A5 = -0.05165
-        A6 = 0.5475
-        A7 = -0.7361
-        A8 = 0.1844
-        A9 = 0.1056
-        A10 = 0.6134
-        A11 = 0.7210
-
-        error = self.LARGE
-        iter = 0
+    @staticmethod
+    def computePseudoCriticalProperties(gas_gravity):
+        # pseudo critical pressure (psia) and temperature (Rankine), arrays or scalars
         Ppc = 756.8 - 131.0 * gas_gravity - 3.60 * (gas_gravity ** 2.0)
         Tpc = 169.2 + 349.5 * gas_gravity - 74.0 * (gas_gravity ** 2.0)
+        return Ppc, Tpc
+
+    @staticmethod
+    def _pseudoCriticalDerivatives(gas_gravity):
+        # dPpc/dgas_gravity and dTpc/dgas_gravity of computePseudoCriticalProperties
+        return -131.0 - 7.20 * gas_gravity, 349.5 - 148.0 * gas_gravity
+
+    @classmethod
+    def computePseudoReducedProperties(cls, pressure, gas_gravity, temperature):
+        # pseudo reduced pressure and temperature, arrays or scalars
+        Ppc, Tpc = cls.computePseudoCriticalProperties(gas_gravity)
         Tpr = (temperature + 459.67) / Tpc
         Ppr = pressure / Ppc
-        Rpr = 0.27 * Ppr / (Zfactor * Tpr)
-        assert Tpr >= 1.0 and Tpr <= 3.0, 'Pseudo Reduced Temperature, Tpr: ' + str(
-            Tpr) + ' is Out Of Bounds: 1.0 <= Tpr <=3.0'
+        return Ppr, Tpr
+
+    def zFactorValidityMask(self, pressure, gas_gravity, temperature):
+        # True where Tpr is within ZFACTOR_TPR_RANGE, for all points at once
+        Ppr, Tpr = self.computePseudoReducedProperties(np.asarray(pressure, dtype=float),
+                                                       np.asarray(gas_gravity, dtype=float),
+                                                       np.asarray(temperature, dtype=float))
+        lower, upper = self.ZFACTOR_TPR_RANGE
+        return np.broadcast_to((Tpr >= lower) & (Tpr <= upper), np.broadcast(Ppr, Tpr).shape)
+
+    def solveDryGasZFactor(self, pressure, gas_gravity, temperature, n_iterations=None):
+        # Dranchuk and Abou-Kassem, 1975-Default EMPower
+        # Batched Newton-Raphson: every (pressure, gas_gravity, temperature) point is
+        # converged together and points drop out of the loop once they converge.
+        # n_iterations (default self.zFactorIterations): run exactly that many Newton steps on
+        # every point instead, so Z is a smooth, deterministic function of the inputs with no
+        # tolerance dependent stopping.
+        # Points out of the Tpr range, or whose Z-factor is not positive, get Z = NaN and
+        # converged = False instead of failing the whole batch.
+        # Returns the Z-factor, the Newton iterations used and the convergence flag
+        # per point (scalars for scalar inputs).
+        n_iterations = self.zFactorIterations if n_iterations is None else n_iterations
+
+        pressure, gas_gravity, temperature = np.broadcast_arrays(np.asarray(pressure, dtype=float),
+                                                                 np.asarray(gas_gravity, dtype=float),
+                                                                 np.asarray(temperature, dtype=float))
+        shape = pressure.shape
+        pressure = pressure.ravel()
+        gas_gravity = gas_gravity.ravel()
+        temperature = temperature.ravel()
+
+        Ppr, Tpr = self.computePseudoReducedProperties(pressure, gas_gravity, temperature)
+        valid = self.zFactorValidityMask(pressure, gas_gravity, temperature)
         # assert Ppr >= 0.2 and Ppr <= 30.0, 'Pseudo Reduced Pressure   , Ppr: ' + str(Ppr) + ' for Region: ' + str(
         # regionNum) + ' is Out Of Bounds: 0.2 <= Ppr <=30.0'
+
+        # Note: Tpc is computed in Rankine according to correlation
+        # Starling-Carnahan equation of state
+        # 1.0 <= Tpr <=3.0
+        # 0.2 <= Ppr <= 30.0 and
+        # the coefficients only depend on Tpr and Ppr, so they are computed once
+        coefficients = self._dakCoefficients(Ppr, Tpr)
+
+        Rpr = coefficients[1].copy()  # initial guess Z = 1
+        iters = np.zeros(Rpr.shape, dtype=int)
+        converged = np.zeros(Rpr.shape, dtype=bool)
+        active = np.flatnonzero(valid)
         # Newton Raphson to evaluate Density
-        while (error > self.TINY and iter < self.iterMax):
-            # Note: Tpc is computed in Rankine according to correlation
-            # Starling-Carnahan equation of state
-            # 1.0 <= Tpr <=3.0
-            # 0.2 <= Ppr <= 30.0 and
-            Rpr_Old = Rpr
-            a = (A1 + A2 / Tpr + A3 / (Tpr ** 3) + A4 / (Tpr ** 4) + A5 / (Tpr ** 5))
-            b = 0.27 * Ppr / Tpr
-            c = A6 + A7 / Tpr + A8 / (Tpr ** 2)
-            d = A9 * (A7 / Tpr + A8 / (Tpr ** 2))
-            e = A10 / (Tpr ** 3)
-            Zr = 1.0 + a * Rpr - b / Rpr + c * (Rpr ** 2) - d * (Rpr ** 5) + e * (1 + A11 * (Rpr ** 2)) * (
-                    Rpr ** 2) * np.exp(-A11 * (Rpr ** 2))
-            Zprime = a + b / (Rpr ** 2) + 2 * c * Rpr - 5 * d * (Rpr ** 4) + 2 * e * Rpr * np.exp(-A11 * (Rpr ** 2)) * (
-                    1 + 2 * A11 * (Rpr ** 3) - A11 * (Rpr ** 2) * (1 + A11 * (Rpr ** 2)))
-            Rpr = Rpr_Old - Zr / Zprime
-            error = np.fabs(Rpr - Rpr_Old)
-            iter += 1
-        Zr = 0.27 * Ppr / (Rpr * Tpr)
-        assert Zr > 0.0, 'Error in Compressibility Computation '  'error: ' + str(error) + ' iter: ' + str(
-            iter) + ' Zr: ' + str(Zr) + ' pressure: ' + str(pressure)
-        self.Zfactor = Zr
+        for _ in range(self.iterMax if n_iterations is None else n_iterations):
+            if active.size == 0:
+                break
+            Rpr_Old = Rpr[active]
+            Zr, Zprime = self._dakResidual(Rpr_Old, *(k[active] for k in coefficients))
+            Rpr_New = Rpr_Old - Zr / Zprime
+            Rpr[active] = Rpr_New
+            iters[active] += 1
+            done = np.fabs(Rpr_New - Rpr_Old) <= self.TINY
+            if n_iterations is None:
+                converged[active[done]] = True
+                active = active[~done]
+            else:
+                converged[active] = done
 
-    def computeDryGasViscosity(self, temperature, pressure, gas_gravity):
-        self.computeDryGasZFactor(pressure, gas_gravity, temperature)
+        Zr = 0.27 * Ppr / (Rpr * Tpr)
+        failed = ~valid | ~(Zr > 0.0)
+        Zr[failed] = np.nan
+        converged[failed] = False
+        return _squeeze(Zr.reshape(shape)), _squeeze(iters.reshape(shape)), _squeeze(converged.reshape(shape))
+
+    def _dakCoefficients(self, Ppr, Tpr):
+        # coefficients a, b, c, d and e of the Dranchuk-Abou-Kassem equation in the reduced density
+        A1, A2, A3, A4, A5, A6, A7, A8, A9, A10, A11 = self.DAK_COEFFICIENTS
+        a = (A1 + A2 / Tpr + A3 / (Tpr ** 3) + A4 / (Tpr ** 4) + A5 / (Tpr ** 5))
+        b = 0.27 * Ppr / Tpr
+        c = A6 + A7 / Tpr + A8 / (Tpr ** 2)
+        d = A9 * (A7 / Tpr + A8 / (Tpr ** 2))
+        e = A10 / (Tpr ** 3)
+        return a, b, c, d, e
+
+    def _dakResidual(self, Rpr, a, b, c, d, e):
+        # residual of the Dranchuk-Abou-Kassem equation at the reduced density Rpr and its
+        # derivative with respect to Rpr
+        A11 = self.DAK_COEFFICIENTS[10]
+        Rpr2 = Rpr ** 2
+        exp_term = np.exp(-A11 * Rpr2)
+        Zr = 1.0 + a * Rpr - b / Rpr + c * Rpr2 - d * (Rpr ** 5) + e * (1 + A11 * Rpr2) * (
+            Rpr2) * exp_term
+        Zprime = a + b / Rpr2 + 2 * c * Rpr - 5 * d * (Rpr ** 4) + 2 * e * Rpr * exp_term * (
+                1 + 2 * A11 * Rpr2 - A11 * Rpr2 * (1 + A11 * Rpr2))
+        return Zr, Zprime
+
+    def computeDryGasZFactorDerivatives(self, pressure, gas_gravity, temperature, n_iterations=None):
+        # Z-factor with dZ/dP (1/psia) and dZ/dT (1/F), see _zFactorReducedDerivatives
+        Z, dZ_dPpr, dZ_dTpr = self._zFactorReducedDerivatives(pressure, gas_gravity, temperature,
+                                                              n_iterations=n_iterations)
+        Ppc, Tpc = self.computePseudoCriticalProperties(np.asarray(gas_gravity, dtype=float))
+        return _squeeze(Z), _squeeze(dZ_dPpr / Ppc), _squeeze(dZ_dTpr / Tpc)
+
+    def _zFactorReducedDerivatives(self, pressure, gas_gravity, temperature, n_iterations=None):
+        # Z-factor with dZ/dPpr and dZ/dTpr, by implicit differentiation of the
+        # Dranchuk-Abou-Kassem equation F(Rpr; Ppr, Tpr) = 0 at the solution:
+        # dRpr/dx = -(dF/dx) / (dF/dRpr), with Z = 0.27 Ppr / (Rpr Tpr)
+        A1, A2, A3, A4, A5, A6, A7, A8, A9, A10, A11 = self.DAK_COEFFICIENTS
+        Z = np.asarray(self.solveDryGasZFactor(pressure, gas_gravity, temperature, n_iterations=n_iterations)[0])
+        pressure, gas_gravity, temperature = (np.asarray(value, dtype=float)
+                                              for value in (pressure, gas_gravity, temperature))
+        Ppr, Tpr = self.computePseudoReducedProperties(pressure, gas_gravity, temperature)
+        Rpr = 0.27 * Ppr / (Z * Tpr)
+
+        a, b, c, d, e = self._dakCoefficients(Ppr, Tpr)
+        F_Rpr = self._dakResidual(Rpr, a, b, c, d, e)[1]
+
+        Rpr2 = Rpr ** 2
+        # derivatives of the coefficients with respect to Tpr (only b depends on Ppr)
+        da = -A2 / Tpr ** 2 - 3 * A3 / Tpr ** 4 - 4 * A4 / Tpr ** 5 - 5 * A5 / Tpr ** 6
+        db = -b / Tpr
+        dc = -A7 / Tpr ** 2 - 2 * A8 / Tpr ** 3
+        dd = A9 * dc
+        de = -3 * A10 / Tpr ** 4
+        F_Tpr = da * Rpr - db / Rpr + dc * Rpr2 - dd * Rpr ** 5 + de * (1 + A11 * Rpr2) * Rpr2 * np.exp(
+            -A11 * Rpr2)
+        F_Ppr = -0.27 / (Tpr * Rpr)
+
+        dZ_dPpr = Z / Ppr + Z / Rpr * F_Ppr / F_Rpr
+        dZ_dTpr = -Z / Tpr + Z / Rpr * F_Tpr / F_Rpr
+        return Z, dZ_dPpr, dZ_dTpr
+
+    def computeDryGasCompressibility(self, pressure, gas_gravity, temperature):
+        # isothermal gas compressibility (1/psia), cg = 1/P - (dZ/dP) / Z
+        Z, dZ_dP, dZ_dT = self.computeDryGasZFactorDerivatives(pressure, gas_gravity, temperature)
+        return 1.0 / pressure - dZ_dP / Z
+
+    def computeDryGasViscosity(self, temperature, pressure, gas_gravity, Zfactor=None):
+        if Zfactor is None:
+            Zfactor = self.computeDryGasZFactor(pressure, gas_gravity, temperature)
         GasMa = self.AirMolecularWt * gas_gravity
-        GasDensity = self.computeDryGasDensity(GasMa, temperature, pressure)
+        GasDensity = self.computeDryGasDensity(GasMa, temperature, pressure, Zfactor=Zfactor)
         Mg = GasMa
         A = (9.379 + 0.01607 * Mg) * (temperature + 459.67) ** 1.5 / (209.2 + 19.26 * Mg + (temperature + 459.67))
         B = 3.448 + (986.4 / (temperature + 459.67)) + 0.01009 * Mg
@@ -203,27 +673,26 @@ class PVTCORR:
         Visc_gas = A * 1e-4 * np.exp(B * (GasDensity ** C))
         return Visc_gas
 
-    def computeDryGasDensity(self, GasMa, temperature, pressure):
+    def computeDryGasDensity(self, GasMa, temperature, pressure, Zfactor=None):
+        if Zfactor is None:
+            Zfactor = self.computeDryGasZFactor(pressure, GasMa / self.AirMolecularWt, temperature)
         GasConstant = 10.73
         FarToRankine = 459.67
         lbFt3ToGmCc = 1 / 62.428
         fac = GasMa / GasConstant * lbFt3ToGmCc
         # Den = Ma*P/ZRT
-        GasDensity = fac * pressure / (self.Zfactor * (temperature + FarToRankine))
+        GasDensity = fac * pressure / (Zfactor * (temperature + FarToRankine))
         return GasDensity
 
-    def computeWaterFVF(self, temperature, pressure):
+    def computeWaterFVF(self, temperature, pressure, sat_pressure=None):
         dVwp = -1.95301e-9 * temperature * pressure - 1.72834e-13 * temperature * (
                 pressure ** 2) - 3.58922e-7 * pressure - 2.25341e-10 * (pressure ** 2)
         dVwt = -1.0001e-2 + 1.33391e-4 * temperature + 5.50654e-7 * (temperature ** 2)
-        Pctrl = self.sat_pressure
-        if pressure <= Pctrl:
-            Bw = (1.0 + dVwt) * (1.0 + dVwp)
-        else:
-            Cw = self.computeIsothermalWaterCompressiblity(pressure, temperature)
-            Bwb = (1.0 + dVwt) * (1.0 + dVwp)
-            Bw = Bwb / (1.0 + Cw * (pressure - Pctrl))
-        return Bw
+        Pctrl = self.sat_pressure if sat_pressure is None else sat_pressure
+        Bwb = (1.0 + dVwt) * (1.0 + dVwp)
+        Cw = self.computeIsothermalWaterCompressiblity(pressure, temperature)
+        Bw = np.where(pressure <= Pctrl, Bwb, Bwb / (1.0 + Cw * (pressure - Pctrl)))
+        return _squeeze(Bw)
         # if self.FluidType[regionNum] != 'Drygas':
         #     self.computeWaterFVFAboveBubblePt(regionNum)
 
@@ -251,43 +720,313 @@ class PVTCORR:
                 0.9994 + 4.0295 * 1e-5 * pressure + 3.1062 * 1e-9 * (pressure ** 2))
         return Visc_water
 
+    def validPVTRows(self, pvt_table=None):
+        # True for the rows of the measured table whose pressure and properties are all finite
+        # and positive, the only ones the relative residuals of the matching can use
+        pvt_table = self.pvt_table if pvt_table is None else pvt_table
+        values = pvt_table[['p'] + list(self.PVT_PROPERTIES)].to_numpy(dtype=float)
+        return np.all(np.isfinite(values) & (values > 0.), axis=1)
+
+    def _getPVTArrays(self, refresh=False):
+        # contiguous float copies of the valid rows of the measured table, built once per pvt_table;
+        # the version changes with the content only and keys the cached objective
+        if refresh or self._pvt_arrays is None or self._pvt_arrays_source is not self.pvt_table:
+            rows = self.validPVTRows()
+            arrays = {key: np.ascontiguousarray(self.pvt_table[key].to_numpy(dtype=float)[rows])
+                      for key in ('p',) + self.PVT_PROPERTIES}
+            if self._pvt_arrays is None or any(not np.array_equal(arrays[key], self._pvt_arrays[key])
+                                               for key in arrays):
+                self._pvt_arrays_version += 1
+            self._pvt_arrays = arrays
+            self._pvt_arrays_source = self.pvt_table
+        return self._pvt_arrays
+
     def _optimizer(self, X):
-        p_array = np.array(self.pvt_table['p'])
-        bo_array = np.array(self.pvt_table['Bo'])
-        bg_array = np.array(self.pvt_table['Bg'])
-        bw_array = np.array(self.pvt_table['Bw'])
-        rgo_array = np.array(self.pvt_table['Rgo'])
-        Visc_oil_array = np.array(self.pvt_table['visc_o'])
-        Visc_gas_array = np.array(self.pvt_table['visc_g'])
-        Visc_water_array = np.array(self.pvt_table['visc_w'])
-        obj = 0.
-        for p, bo, bg, bw, rgo, vo, vg, vw in zip(p_array, bo_array, bg_array,
-                                                  bw_array, rgo_array, Visc_oil_array,
-                                                  Visc_gas_array, Visc_water_array):
-            Rso = self._computeSolutionGasOilRatio(X[0], X[2], p, X[1]) - rgo
-            Bo = self._computeLiveOilFVF(X[0], X[2], p, X[1]) - bo
-            Bg = self.computeDryGasFVF(p, X[2], X[1]) - bg
-            Bw = self.computeWaterFVF(X[2], p) - bw
-            Visc_o = self.computeLiveOilViscosity(X[0], X[2], p, X[1]) - vo
-            Visc_g = self.computeDryGasViscosity(X[2], p, X[1]) - vg
-            Visc_w = self.computerWaterViscosity(p, X[2]) - vw
-            obj += (Bo / bo) ** 2 + (Bg / bg) ** 2 + (Bw / bw) ** 2 + (Rso / rgo) ** 2 + (Visc_o / vo) ** 2 + \
-                   (Visc_g / vg) ** 2 + (Visc_w / vw) ** 2
-            # obj+=(Bo/bo) ** 2 + (Bg/bg) ** 2  + (Rso/rgo) ** 2 + \
-            #      (Visc_g/vg)**2 + (Visc_o/vo)**2
-            # obj+=(Bo/bo) ** 2 + (Rso/rgo) ** 2
-            # obj += (Rso / rgo) ** 2
+        return self._objective(X, self._getPVTArrays())
+
+    def _residuals(self, X, table):
+        # relative residuals of the seven properties, concatenated along the last axis.
+        # X is one candidate (api, gas_gravity, temperature) of shape (3,) or a whole
+        # population of shape (3, S) as passed by differential_evolution(vectorized=True);
+        # candidates x pressure steps are evaluated as one (S, 7 * n) array
+        api, gas_gravity, temperature = (x[..., np.newaxis] for x in np.asarray(X, dtype=float))
+        # candidates outside the validity range of a correlation (NaN properties) are penalized
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            calculated = self.computePVTProperties(api, gas_gravity, temperature, table['p'])
+            residuals = np.concatenate([(calculated[key] - table[key]) / table[key]
+                                        for key in self.PVT_PROPERTIES], axis=-1)
+        return np.where(np.isfinite(residuals), residuals, self.LARGE)
+
+    def _residualsJacobian(self, X, table):
+        # Analytic Jacobian of _residuals with respect to (api, gas_gravity, temperature), from
+        # computePVTPropertyDerivatives; residuals replaced by the LARGE penalty have no gradient
+        api, gas_gravity, temperature = np.asarray(X, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            derivatives = self.computePVTPropertyDerivatives(api, gas_gravity, temperature, table['p'])
+            jacobian = np.concatenate([np.stack(derivatives[key], axis=-1) / table[key][:, np.newaxis]
+                                       for key in self.PVT_PROPERTIES], axis=0)
+        return np.where(np.isfinite(jacobian), jacobian, 0.)
+
+    def _objective(self, X, table):
+        obj = np.sum(self._residuals(X, table) ** 2, axis=-1)
+        # obj+=(Bo/bo) ** 2 + (Bg/bg) ** 2  + (Rso/rgo) ** 2 + \
+        #      (Visc_g/vg)**2 + (Visc_o/vo)**2
+        # obj+=(Bo/bo) ** 2 + (Rso/rgo) ** 2
+        # obj += (Rso / rgo) ** 2
 
         return obj
 
-    def match_PVT_values(self, range_of_values, additional_details=False):
-        res = differential_evolution(self._optimizer, range_of_values, seed=100, strategy='best2exp')
+    def _matchPVT(self, range_of_values, seed=100, vectorized=False, sample=None, method='de'):
+        # vectorized=True scores the whole population in a single call of _optimizer
+        # (population updates are then deferred, so the search path differs slightly).
+        # method='hybrid' runs a short differential evolution with a small population and
+        # polishes its best member with a trust-region least squares on the residuals, using
+        # their analytic Jacobian (_residualsJacobian).
+        table = self._getPVTArrays(refresh=True)
+        if method == 'de':
+            de_options = {}
+        elif method == 'hybrid':
+            de_options = {'popsize': 5, 'maxiter': 30, 'polish': False}
+        else:
+            raise ValueError(f'Unknown method ({method}) for matching PVT values')
+
+        if vectorized:
+            res = differential_evolution(self._optimizer, range_of_values, seed=seed, strategy='best2exp',
+                                         vectorized=True, updating='deferred', **de_options)
+        else:
+            res = differential_evolution(self._optimizer, range_of_values, seed=seed, strategy='best2exp',
+                                         **de_options)
+
+        if method == 'hybrid':
+            lower, upper = np.array(range_of_values, dtype=float).T
+            ls = least_squares(self._residuals, res.x, args=(table,),
+                               jac=self._residualsJacobian,
+                               bounds=(lower, upper), method='trf', x_scale='jac')
+            res = OptimizeResult(x=ls.x, fun=2 * ls.cost, nfev=res.nfev + ls.nfev, njev=ls.njev, nit=res.nit,
+                                 success=ls.success, message=ls.message,
+                                 population=res.population, population_energies=res.population_energies)
+        # kept to warm start rematch_PVT_values when new rows arrive for this sample;
+        # differential_evolution keeps the best member first, polished or not
+        population = res.population.copy()
+        energies = res.population_energies.copy()
+        population[0] = res.x
+        energies[0] = res.fun
+        self._match_state[sample] = {'population': population,
+                                     'population_energies': energies}
+        return res
+
+    def match_PVT_values(self, range_of_values, additional_details=False, vectorized=False, seed=100,
+                         sample=None, method='de'):
+        res = self._matchPVT(range_of_values, seed=seed, vectorized=vectorized, sample=sample, method=method)
         if additional_details:
             print(res)
         return res.x
 
-    def compute_PVT_values(self, api, gas_gravity, temperature):
-        p_array = np.array(self.pvt_table['p'])
+    def rematch_PVT_values(self, new_rows, range_of_values, additional_details=False, sample=None, vectorized=False,
+                           seed=100, method='de'):
+        # Incremental matching after new pressure steps are appended to pvt_table.
+        # The objective is a sum over rows, so the energies of the population stored by the
+        # previous fit are updated by evaluating the new rows only; the best member then
+        # seeds a bounded local refinement on the full table instead of a new global search.
+        # Falls back to match_PVT_values, with vectorized, seed and method, when this sample has
+        # not been matched before.
+        state = self._match_state.get(sample)
+        self.pvt_table = pd.concat([self.pvt_table, new_rows], ignore_index=True)
+        if state is None:
+            return self.match_PVT_values(range_of_values, additional_details=additional_details, vectorized=vectorized,
+                                         seed=seed, sample=sample, method=method)
+
+        rows = self.validPVTRows(new_rows)
+        new_table = {key: np.ascontiguousarray(new_rows[key].to_numpy(dtype=float)[rows])
+                     for key in ('p',) + self.PVT_PROPERTIES}
+        population = state['population'].copy()
+        energies = state['population_energies'] + self._objective(population.T, new_table)
+        best = np.argmin(energies)
+
+        self._getPVTArrays(refresh=True)
+        res = minimize(self._optimizer, population[best], bounds=range_of_values, method='L-BFGS-B')
+        if res.fun < energies[best]:
+            population[best] = res.x
+            energies[best] = res.fun
+        best = np.argmin(energies)
+        self._match_state[sample] = {'population': population,
+                                     'population_energies': energies}
+        if additional_details:
+            print(res)
+        return population[best]
+
+    def _copyForTable(self, pvt_table):
+        # light copy of the correlation settings bound to another PVT table; the saturation
+        # pressure is taken from a 'p_sat' column when the table has one
+        pvtcorr = copy.copy(self)
+        # the cache and profiling wrappers are bound to self
+        pvtcorr.disable_profiling()
+        pvtcorr.disable_cache()
+        pvtcorr.pvt_table = pvt_table
+        pvtcorr._pvt_arrays = None
+        pvtcorr._pvt_arrays_source = None
+        pvtcorr._match_state = {}
+        if 'p_sat' in pvt_table.columns:
+            pvtcorr.sat_pressure = float(pvt_table['p_sat'].iloc[0])
+        return pvtcorr
+
+    def match_PVT_tables(self, tables, range_of_values, group_by=None, n_jobs=None, seed=100, vectorized=True,
+                         method='de'):
+        # Fits many PVT tables, one differential evolution per sample, across a process pool.
+        # tables: dict {sample: DataFrame}, list of DataFrames, or one DataFrame split by the
+        # group_by column(s). n_jobs=1 runs in this process, None uses all cores.
+        # Every sample gets its own seed derived from (seed, sample), so results do not
+        # depend on the number of workers nor on which other samples are in the batch.
+        if isinstance(tables, pd.DataFrame):
+            samples = list(tables.groupby(group_by, sort=True))
+        elif isinstance(tables, dict):
+            samples = list(tables.items())
+        else:
+            samples = list(enumerate(tables))
+
+        jobs = []
+        for sample, pvt_table in samples:
+            sample_seed = np.random.SeedSequence([seed, zlib.crc32(str(sample).encode())])
+            jobs.append((self._copyForTable(pvt_table), sample, range_of_values,
+                         int(sample_seed.generate_state(1)[0]), vectorized, method))
+
+        if n_jobs == 1:
+            results = [_match_PVT_table(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(_match_PVT_table, jobs))
+
+        return pd.DataFrame(results).set_index('sample')
+
+    def computePVTProperties(self, api, gas_gravity, temperature, pressure, sat_pressure=None):
+        # Stateless evaluation of every correlation: nothing is read from or written to
+        # the instance apart from its constants, so one PVTCORR can be shared by threads.
+        # Rso, Rso(Psat) and Z are computed once and shared between the properties.
+        Psat = self.sat_pressure if sat_pressure is None else sat_pressure
+        Rso = self._computeSolutionGasOilRatio(api, temperature, pressure, gas_gravity, sat_pressure=Psat)
+        Rso_sat = self._computeSolutionGasOilRatio(api, temperature, Psat, gas_gravity, sat_pressure=Psat)
+        Zfactor = self.computeDryGasZFactor(pressure, gas_gravity, temperature)
+        properties = {'Rgo': Rso,
+                      'Bo': self._computeLiveOilFVF(api, temperature, pressure, gas_gravity, sat_pressure=Psat,
+                                                    Rso=Rso, Rso_sat=Rso_sat),
+                      'Bg': self.computeDryGasFVF(pressure, temperature, gas_gravity, Zfactor=Zfactor),
+                      'Bw': self.computeWaterFVF(temperature, pressure, sat_pressure=Psat),
+                      'visc_o': self.computeLiveOilViscosity(api, temperature, pressure, gas_gravity,
+                                                             sat_pressure=Psat, Rso=Rso),
+                      'visc_g': self.computeDryGasViscosity(temperature, pressure, gas_gravity, Zfactor=Zfactor),
+                      'visc_w': self.computerWaterViscosity(pressure, temperature)}
+        return properties
+
+    def computePVTPropertyDerivatives(self, api, gas_gravity, temperature, pressure, sat_pressure=None):
+        # Derivatives of every computePVTProperties property with respect to api, gas_gravity and
+        # temperature, in closed form: {property: (d/dapi, d/dgas_gravity, d/dtemperature)}.
+        # The light/heavy oil coefficients and the Psat branches are piecewise constant; the
+        # Z-factor terms come from the implicit differentiation of the DAK equation.
+        Psat = self.sat_pressure if sat_pressure is None else sat_pressure
+        api, gas_gravity, temperature, pressure = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in
+                                                                        (api, gas_gravity, temperature, pressure)))
+        zero = np.zeros(pressure.shape)
+        TR = temperature + 459.67
+        below = pressure <= Psat
+
+        # gas gravity at separator conditions, Gamma_gs = gas_gravity * (1 + K * api)
+        K = 5.912e-5 * self.Tsp * np.log10(self.Psp / 114.7)
+        Gamma_gs = self._computeGasGravityAtSeparatorConditions(gas_gravity, api)
+        dGamma = (gas_gravity * K, 1.0 + K * api, zero)
+
+        # solution gas oil ratio, ln Rs = ln(C1 Gamma_gs) + C2 ln(min(p, Psat)) + C3 api / TR
+        C3 = np.where(np.greater(api, 30.0 + 1e-12), 23.9310, 25.7240)
+        Rso = self._computeSolutionGasOilRatio(api, temperature, pressure, gas_gravity, sat_pressure=Psat)
+        Rso_sat = self._computeSolutionGasOilRatio(api, temperature, Psat, gas_gravity, sat_pressure=Psat)
+        dlnRs = (dGamma[0] / Gamma_gs + C3 / TR, dGamma[1] / Gamma_gs, -C3 * api / TR ** 2)
+        dRso = tuple(Rso * d for d in dlnRs)
+        dRso_sat = tuple(Rso_sat * d for d in dlnRs)
+
+        # oil formation volume factor, Bo = 1 + C1 Rs + C2 q + C3 q Rs with q = (T - 60) api / Gamma_gs,
+        # times exp(-Co (p - Psat)) above Psat
+        light = np.greater(api, 30.0 + 1e-12)
+        C1_bo = np.where(light, 4.670e-4, 4.677e-4)
+        C2_bo = np.where(light, 1.100e-5, 1.751e-5)
+        C3_bo = np.where(light, 1.337e-9, -1.811e-8)
+        q = (temperature - 60) * api / Gamma_gs
+        dq = ((temperature - 60) * (1.0 / Gamma_gs - api * dGamma[0] / Gamma_gs ** 2),
+              -(temperature - 60) * api * dGamma[1] / Gamma_gs ** 2,
+              api / Gamma_gs)
+        Bo_sat = 1.0 + C1_bo * Rso + C2_bo * q + C3_bo * q * Rso
+        dBo_sat = tuple(C1_bo * dR + C2_bo * dq_ + C3_bo * (dq_ * Rso + q * dR) for dR, dq_ in zip(dRso, dq))
+        Co = self._computeIsothermalLiveOilCompressibilityAbovePsat(api, temperature, pressure, gas_gravity,
+                                                                    sat_pressure=Psat, GOR=Rso_sat)
+        dCo = tuple((5.0 * dRs - 1180.0 * dG + explicit) / (pressure * 1e+5)
+                    for dRs, dG, explicit in zip(dRso_sat, dGamma, (12.61, 0., 17.2)))
+        shrink = np.exp(-Co * (pressure - Psat))
+        dBo = tuple(np.where(below, dB, shrink * (dB - Bo_sat * (pressure - Psat) * dC))
+                    for dB, dC in zip(dBo_sat, dCo))
+
+        # live oil viscosity, ln visc_o = ln a(Rs) + b(Rs) ln visc_od(api, T)
+        a_od = np.exp(6.9824 - 0.04658 * api) * temperature ** (-1.163)
+        Visc_od = 10 ** a_od - 1
+        dVisc_od = tuple(np.log(10) * 10 ** a_od * d for d in (-0.04658 * a_od, zero, -1.163 * a_od / temperature))
+        b_o = 5.44 * ((Rso + 150.0) ** (-0.338))
+        Visc_o = self.computeLiveOilViscosity(api, temperature, pressure, gas_gravity, sat_pressure=Psat, Rso=Rso)
+        dVisc_o = tuple(Visc_o * (-0.515 * dR / (Rso + 100.0) - 0.338 * b_o * dR / (Rso + 150.0) * np.log(Visc_od)
+                                  + b_o * dV / Visc_od)
+                        for dR, dV in zip(dRso, dVisc_od))
+
+        # Z-factor through the pseudo reduced properties
+        Z, dZ_dPpr, dZ_dTpr = self._zFactorReducedDerivatives(pressure, gas_gravity, temperature)
+        Ppc, Tpc = self.computePseudoCriticalProperties(gas_gravity)
+        dPpc, dTpc = self._pseudoCriticalDerivatives(gas_gravity)
+        dZ = (zero, -dZ_dPpr * pressure * dPpc / Ppc ** 2 - dZ_dTpr * TR * dTpc / Tpc ** 2, dZ_dTpr / Tpc)
+
+        # gas formation volume factor, Bg = fac Z TR / p
+        Bg = self.computeDryGasFVF(pressure, temperature, gas_gravity, Zfactor=Z)
+        dBg = (zero, Bg * dZ[1] / Z, Bg * (dZ[2] / Z + 1.0 / TR))
+
+        # gas viscosity, ln visc_g = ln A + ln 1e-4 + B density ** C
+        Mg = self.AirMolecularWt * gas_gravity
+        density = self.computeDryGasDensity(Mg, temperature, pressure, Zfactor=Z)
+        Visc_g = self.computeDryGasViscosity(temperature, pressure, gas_gravity, Zfactor=Z)
+        den = 209.2 + 19.26 * Mg + TR
+        dlnA = (zero, self.AirMolecularWt * (0.01607 / (9.379 + 0.01607 * Mg) - 19.26 / den), 1.5 / TR - 1.0 / den)
+        B = 3.448 + (986.4 / TR) + 0.01009 * Mg
+        C = 2.447 - 0.2224 * B
+        dB = (zero, 0.01009 * self.AirMolecularWt + zero, -986.4 / TR ** 2)
+        dlnDensity = (zero, 1.0 / gas_gravity - dZ[1] / Z, -dZ[2] / Z - 1.0 / TR)
+        dVisc_g = tuple(Visc_g * (dA_ + density ** C * (dB_ + B * (-0.2224 * dB_ * np.log(density) + C * dD)))
+                        for dA_, dB_, dD in zip(dlnA, dB, dlnDensity))
+
+        # water formation volume factor and viscosity depend on temperature only
+        dVwp = -1.95301e-9 * temperature * pressure - 1.72834e-13 * temperature * (
+                pressure ** 2) - 3.58922e-7 * pressure - 2.25341e-10 * (pressure ** 2)
+        dVwt = -1.0001e-2 + 1.33391e-4 * temperature + 5.50654e-7 * (temperature ** 2)
+        Bwb = (1.0 + dVwt) * (1.0 + dVwp)
+        dBwb = (1.33391e-4 + 2 * 5.50654e-7 * temperature) * (1.0 + dVwp) + (1.0 + dVwt) * (
+                -1.95301e-9 * pressure - 1.72834e-13 * pressure ** 2)
+        Cw = self.computeIsothermalWaterCompressiblity(pressure, temperature)
+        expansion = 1.0 + Cw * (pressure - Psat)
+        dBw = np.where(below, dBwb, dBwb / expansion - Bwb * (pressure - Psat) * 537.0 * Cw ** 2 / expansion ** 2)
+        Visc_w = self.computerWaterViscosity(pressure, temperature)
+        Sal = self.Salinity * 1e-4
+        B_w = 1.12166 - 2.63951 * 1e-2 * Sal + 6.79461 * 1e-4 * (Sal ** 2) + 5.47119 * 1e-5 * (
+                Sal ** 3) - 1.55586 * 1e-6 * (Sal ** 4)
+
+        derivatives = {'Rgo': dRso,
+                       'Bo': dBo,
+                       'Bg': dBg,
+                       'Bw': (zero, zero, dBw),
+                       'visc_o': dVisc_o,
+                       'visc_g': dVisc_g,
+                       'visc_w': (zero, zero, -B_w * Visc_w / temperature)}
+        return {key: tuple(np.broadcast_to(d, pressure.shape) for d in value) for key, value in derivatives.items()}
+
+    def build_PVT_table(self, api, gas_gravity, temperature, sat_pressure=None, p_min=14.7, p_max=10000.,
+                        n_points=200, kind='pchip', n_check=8):
+        # precomputed pressure table of all properties for a fitted fluid, see PVTTable
+        return PVTTable(self, api, gas_gravity, temperature, sat_pressure=sat_pressure, p_min=p_min, p_max=p_max,
+                        n_points=n_points, kind=kind, n_check=n_check)
+
+    def compute_PVT_values(self, api, gas_gravity, temperature, sat_pressure=None):
+        p_array = np.array(self.pvt_table['p'], dtype=float)
         bo_array = np.array(self.pvt_table['Bo'])
         bg_array = np.array(self.pvt_table['Bg'])
         bw_array = np.array(self.pvt_table['Bw'])
@@ -295,44 +1034,330 @@ class PVTCORR:
         Visc_oil_array = np.array(self.pvt_table['visc_o'])
         Visc_gas_array = np.array(self.pvt_table['visc_g'])
         Visc_water_array = np.array(self.pvt_table['visc_w'])
-        comparison_dict = defaultdict(list)
-        for p, bo, bg, bw, rgo, vo, vg, vw in zip(p_array, bo_array, bg_array, bw_array, rgo_array, Visc_oil_array,
-                                                  Visc_gas_array, Visc_water_array):
-            rgo_c = self._computeSolutionGasOilRatio(api, temperature, p, gas_gravity)
-            bo_c = self._computeLiveOilFVF(api, temperature, p, gas_gravity)
-            bg_c = self.computeDryGasFVF(p, temperature, gas_gravity)
-            bw_c = self.computeWaterFVF(temperature, p)
-            Visc_o = self.computeLiveOilViscosity(api, temperature, p, gas_gravity)
-            Visc_g = self.computeDryGasViscosity(temperature, p, gas_gravity)
-            Visc_w = self.computerWaterViscosity(p, temperature)
-            comparison_dict['Actual_Rgo'].append(rgo)
-            comparison_dict['Calculated_Rgo'].append(rgo_c)
-            comparison_dict['Actual_Bo'].append(bo)
-            comparison_dict['Calculated_Bg'].append(bg_c)
-            comparison_dict['Actual_Bg'].append(bg)
-            comparison_dict['Calculated_Bw'].append(bw_c)
-            comparison_dict['Actual_Bw'].append(bw)
-            comparison_dict['Calculated_Bo'].append(bo_c)
-            comparison_dict['Actual_vo'].append(vo)
-            comparison_dict['Calculated_vo'].append(Visc_o)
-            comparison_dict['Actual_vg'].append(vg)
-            comparison_dict['Calculated_vg'].append(Visc_g)
-            comparison_dict['Actual_vw'].append(vw)
-            comparison_dict['Calculated_vw'].append(Visc_w)
-            comparison_dict['pressure'].append(p)
+
+        # all pressure steps are evaluated in a single array pass
+        calculated = self.computePVTProperties(api, gas_gravity, temperature, p_array, sat_pressure=sat_pressure)
+        rgo_c = calculated['Rgo']
+        bo_c = calculated['Bo']
+        bg_c = calculated['Bg']
+        bw_c = calculated['Bw']
+        Visc_o = calculated['visc_o']
+        Visc_g = calculated['visc_g']
+        Visc_w = calculated['visc_w']
+
+        comparison_dict = {'Actual_Rgo': rgo_array,
+                           'Calculated_Rgo': rgo_c,
+                           'Actual_Bo': bo_array,
+                           'Calculated_Bg': bg_c,
+                           'Actual_Bg': bg_array,
+                           'Calculated_Bw': bw_c,
+                           'Actual_Bw': bw_array,
+                           'Calculated_Bo': bo_c,
+                           'Actual_vo': Visc_oil_array,
+                           'Calculated_vo': Visc_o,
+                           'Actual_vg': Visc_gas_array,
+                           'Calculated_vg': Visc_g,
+                           'Actual_vw': Visc_water_array,
+                           'Calculated_vw': Visc_w,
+                           'pressure': p_array}
         return comparison_dict
 
 
+class PVTTable:
+    # Dense pressure table of every PVTCORR property for one fitted fluid; queries are served by
+    # piecewise monotone (pchip) or cubic interpolation instead of evaluating the correlations.
+    # Rs, Bo and Bw have a kink at the saturation pressure, so the table is interpolated
+    # separately below and above it. Bg ~ 1/p is interpolated as p * Bg, which is smooth.
+    def __init__(self, pvtcorr, api, gas_gravity, temperature, sat_pressure=None, p_min=14.7, p_max=10000.,
+                 n_points=200, kind='pchip', n_check=8):
+        if kind == 'pchip':
+            interpolator = PchipInterpolator
+        elif kind == 'cubic':
+            interpolator = CubicSpline
+        else:
+            raise ValueError(f'Unknown interpolation ({kind}) for the PVT table')
+
+        self.api = api
+        self.gas_gravity = gas_gravity
+        self.temperature = temperature
+        self.sat_pressure = pvtcorr.sat_pressure if sat_pressure is None else sat_pressure
+        if self.sat_pressure is None:
+            raise ValueError('The PVT table needs the saturation pressure of the fluid, pass sat_pressure')
+        self.pvtcorr = pvtcorr
+
+        # Rs ~ p ** C2 and Bg ~ 1 / p bend most at low pressure: half of the nodes are spaced
+        # geometrically, the other half evenly
+        pressure = np.union1d(np.geomspace(p_min, p_max, n_points // 2),
+                              np.linspace(p_min, p_max, n_points - n_points // 2))
+        if p_min < self.sat_pressure < p_max:
+            pressure = np.union1d(pressure, self.sat_pressure)
+        self.pressure = pressure
+        self.properties = pvtcorr.computePVTProperties(api, gas_gravity, temperature, pressure,
+                                                       sat_pressure=self.sat_pressure)
+
+        below = pressure <= self.sat_pressure
+        above = pressure >= self.sat_pressure
+        self._interpolators = {}
+        for key, values in self.properties.items():
+            if key == 'Bg':
+                values = values * pressure
+            segments = []
+            for mask in (below, above):
+                if mask.sum() >= 2:
+                    segments.append(interpolator(pressure[mask], values[mask]))
+            self._interpolators[key] = segments
+
+        # maximum relative interpolation error of each property on a check grid of n_check points
+        # inside every node interval; sampled, so an estimate rather than a strict bound
+        fractions = np.arange(1, n_check + 1) / (n_check + 1)
+        check = (pressure[:-1, np.newaxis] + np.diff(pressure)[:, np.newaxis] * fractions).ravel()
+        exact = pvtcorr.computePVTProperties(api, gas_gravity, temperature, check, sat_pressure=self.sat_pressure)
+        self.error_estimate = {key: np.max(np.abs(self.interpolate(key, check) / exact[key] - 1.))
+                               for key in self.properties}
+
+    def interpolate(self, key, pressure):
+        # key: one of PVTCORR.PVT_PROPERTIES ('Rgo', 'Bo', 'Bg', 'Bw', 'visc_o', 'visc_g', 'visc_w')
+        segments = self._interpolators[key]
+        if len(segments) == 1:
+            values = segments[0](pressure)
+        else:
+            values = np.where(np.asarray(pressure) <= self.sat_pressure, segments[0](pressure), segments[1](pressure))
+        if key == 'Bg':
+            values = values / pressure
+        return _squeeze(values)
+
+    def to_simulator_keywords(self):
+        # PVTO, PVDG and PVTW keywords in field units (psia, rb/stb, Mscf/stb, rb/Mscf, cP).
+        # Every saturated PVTO record is a single line; the record at the saturation pressure
+        # carries the undersaturated branch of the table.
+        p = self.pressure
+        props = self.properties
+        lines = ['PVTO', '-- Rs(Mscf/stb)  P(psia)  Bo(rb/stb)  Visc_o(cP)']
+        saturated = np.flatnonzero(p <= self.sat_pressure)
+        undersaturated = np.flatnonzero(p > self.sat_pressure)
+        for i in saturated:
+            record = '%12.6f %12.4f %12.6f %12.6f' % (props['Rgo'][i] / 1000., p[i], props['Bo'][i], props['visc_o'][i])
+            if i == saturated[-1] and undersaturated.size:
+                lines.append(record)
+                for j in undersaturated:
+                    lines.append('%12s %12.4f %12.6f %12.6f' % ('', p[j], props['Bo'][j], props['visc_o'][j]))
+                lines.append('%12s /' % '')
+            else:
+                lines.append(record + ' /')
+        lines += ['/', '']
+
+        lines += ['PVDG', '-- P(psia)  Bg(rb/Mscf)  Visc_g(cP)']
+        for i in range(p.size):
+            lines.append('%12.4f %12.6f %12.6f' % (p[i], props['Bg'][i] * 1000., props['visc_g'][i]))
+        lines += ['/', '']
+
+        p_ref = self.sat_pressure
+        Bw = self.pvtcorr.computeWaterFVF(self.temperature, p_ref, sat_pressure=self.sat_pressure)
+        Cw = self.pvtcorr.computeIsothermalWaterCompressiblity(p_ref, self.temperature)
+        Visc_w = self.pvtcorr.computerWaterViscosity(p_ref, self.temperature)
+        lines += ['PVTW', '-- Pref(psia)  Bw(rb/stb)  Cw(1/psi)  Visc_w(cP)  Viscosibility(1/psi)',
+                  '%12.4f %12.6f %12.6e %12.6f %12.6e /' % (p_ref, Bw, Cw, Visc_w, 0.), '']
+        return '\n'.join(lines)
+
+
+# Rs correlations of PVTCORR_HGOR, by method name. Every entry holds constant coefficients,
+# a vectorized NumPy kernel(features, C, out), the input bounds where the correlation may be
+# used and, optionally, a scalar version of the kernel that is JIT compiled when numba is
+# installed. New correlations are added with register_rs_correlation, without touching the class.
+RS_CORRELATIONS = {}
+
+# order of the features passed to the compiled kernels
+_RS_FEATURES = ('api', 'temperature', 'gas_gravity', 'ln_t', 'ln_api', 'ln_gas_gravity', 'ln_p')
+
+
+def register_rs_correlation(name, coefficients, bounds=None, scalar_kernel=None):
+    # decorator registering a vectorized Rs kernel; bounds: {input: (min, max)} for
+    # api, temperature, pressure and gas_gravity
+    def decorator(kernel):
+        C = np.array(coefficients, dtype=float)
+        C.setflags(write=False)
+        RS_CORRELATIONS[name] = {'coefficients': C,
+                                 'kernel': kernel,
+                                 'bounds': dict(bounds or {}),
+                                 'scalar_kernel': scalar_kernel,
+                                 'jit_kernel': None}
+        return kernel
+
+    return decorator
+
+
+def _compile_rs_kernel(scalar_kernel):
+    scalar = numba.njit(scalar_kernel)
+
+    @numba.njit
+    def kernel(api, temperature, gas_gravity, ln_t, ln_api, ln_gas_gravity, ln_p, C, out):
+        for i in range(out.size):
+            out[i] = scalar(api[i], temperature[i], gas_gravity[i], ln_t[i], ln_api[i], ln_gas_gravity[i],
+                            ln_p[i], C)
+
+    return kernel
+
+
+def _evaluate_rs_correlation(correlation, features, out):
+    if numba is not None and correlation['scalar_kernel'] is not None and out.flags.c_contiguous:
+        if correlation['jit_kernel'] is None:
+            correlation['jit_kernel'] = _compile_rs_kernel(correlation['scalar_kernel'])
+        correlation['jit_kernel'](*[np.ascontiguousarray(features[key]).ravel() for key in _RS_FEATURES],
+                                  correlation['coefficients'], out.reshape(-1))
+    else:
+        correlation['kernel'](features, correlation['coefficients'], out)
+
+
+# the HGOR correlations are only restricted to the domain where their logarithms are defined
+_RS_LOG_DOMAIN = {'api': (0., np.inf), 'temperature': (0., np.inf), 'pressure': (0., np.inf),
+                  'gas_gravity': (0., np.inf)}
+
+
+def _rs_vasquez_beggs_modified_scalar(api, temperature, gas_gravity, ln_t, ln_api, ln_gas_gravity, ln_p, C):
+    row = 0 if api <= 30 else 1
+    b = - (C[row, 1] * api) / (temperature + 459.67)
+    return gas_gravity * math.exp(C[row, 2] * ln_p + math.log(10.) * b) / C[row, 0]
+
+
+# C1, C2, C3 for api <= 30 (first row) and api > 30 (second row)
+@register_rs_correlation('vasquez_beggs_modified',
+                         [[1.091e+5, 2.3913, 1.e-6],
+                          [3.405e+6, 2.7754, 1.e-6]],
+                         bounds=_RS_LOG_DOMAIN, scalar_kernel=_rs_vasquez_beggs_modified_scalar)
+def _rs_vasquez_beggs_modified(features, C, out):
+    api = features['api']
+    heavy = api <= 30
+    C1 = np.where(heavy, C[0, 0], C[1, 0])
+    C2 = np.where(heavy, C[0, 1], C[1, 1])
+    C3 = np.where(heavy, C[0, 2], C[1, 2])
+
+    # Rs = gas_gravity * pressure ** C3 * 10 ** b / C1, with b = - C2 * api / (T + 459.67)
+    b = - (C2 * api) / (features['temperature'] + 459.67)
+    np.multiply(features['ln_p'], C3, out=out)
+    out += np.log(10.) * b
+    np.exp(out, out=out)
+    out *= features['gas_gravity']
+    out /= C1
+
+
+def _rs_exponential_rational_8_scalar(api, temperature, gas_gravity, ln_t, ln_api, ln_gas_gravity, ln_p, C):
+    a = C[0] + C[1] * ln_t
+    b = C[2] + C[3] * ln_api
+    d = C[6] + C[7] * ln_gas_gravity
+    K = (a / ln_p - 1.) / (b * d)
+    return math.exp((K - C[4]) / C[5])
+
+
+@register_rs_correlation('exponential_rational_8',
+                         [9.021, -0.119, 2.221, -.531, .144, -1.842e-2, 12.802, 8.309],
+                         bounds=_RS_LOG_DOMAIN, scalar_kernel=_rs_exponential_rational_8_scalar)
+def _rs_exponential_rational_8(features, C, out):
+    a = C[0] + C[1] * features['ln_t']
+    b = C[2] + C[3] * features['ln_api']
+    d = C[6] + C[7] * features['ln_gas_gravity']
+
+    # K = (a / ln(p) - 1) / (b * d); ln_Rs = (K - C4) / C5
+    np.divide(a, features['ln_p'], out=out)
+    out -= 1.
+    out /= b * d
+    out -= C[4]
+    out /= C[5]
+    np.exp(out, out=out)
+
+
+def _rs_exponential_rational_16_scalar(api, temperature, gas_gravity, ln_t, ln_api, ln_gas_gravity, ln_p, C):
+    A = (C[0] + C[1] * ln_t) * (C[2] + C[3] * ln_api) * (C[6] + C[7] * ln_gas_gravity)
+    B = (C[8] + C[9] * ln_t) * (C[10] + C[11] * ln_api) * (C[14] + C[15] * ln_gas_gravity)
+    K = ln_p * B / A
+    return math.exp((K * C[12] - C[4]) / (C[5] - K * C[13]))
+
+
+@register_rs_correlation('exponential_rational_16',
+                         [0.858, -7.881e-2,
+                          3.198, -.457,
+                          .146, .322,
+                          3.172, 1.015,
+                          -.34, .54,
+                          -.665, .458,
+                          -.545, 3.343e-2,
+                          .454, -.281],
+                         bounds=_RS_LOG_DOMAIN, scalar_kernel=_rs_exponential_rational_16_scalar)
+def _rs_exponential_rational_16(features, C, out):
+    ln_t = features['ln_t']
+    ln_api = features['ln_api']
+    ln_gas_gravity = features['ln_gas_gravity']
+
+    a = C[0] + C[1] * ln_t
+    e = C[8] + C[9] * ln_t
+
+    b = C[2] + C[3] * ln_api
+    f = C[10] + C[11] * ln_api
+
+    c = C[6] + C[7] * ln_gas_gravity
+    g = C[14] + C[15] * ln_gas_gravity
+
+    A = a * b * c
+    B = e * f * g
+
+    # K = ln(p) * B / A; ln_Rs = (K * C12 - C4) / (C5 - K * C13)
+    np.multiply(features['ln_p'], B, out=out)
+    out /= A
+    denominator = C[5] - C[13] * out
+    out *= C[12]
+    out -= C[4]
+    out /= denominator
+    np.exp(out, out=out)
+
+
 class PVTCORR_HGOR(PVTCORR):
-    def __init__(self, filepath, hgor=2000, **kwargs):
+    # Rs correlations compared by compute_RS_values
+    RS_METHODS = ('Vasquez_Beggs', 'Vasquez_Beggs_modified', 'Exponential_Rational_8', 'Exponential_Rational_16')
+
+    def __init__(self, filepath, hgor=2000, use_cache=True, **kwargs):
 
         super().__init__(**kwargs)
+        self.hgor = hgor
 
         if not os.path.exists(filepath):
-            print('PVT file does not exist:%s' % filepath)
-            sys.exit(1)
+            raise FileNotFoundError('PVT file does not exist:%s' % filepath)
+
+        self.pvt_table = self._loadPVTTable(filepath, hgor, use_cache)
+
+    def _loadPVTTable(self, filepath, hgor, use_cache=True):
+        # The Excel sheet is parsed once and stored, with the derived gamma_gs and HGOR columns,
+        # as a columnar cache in a .pvt_cache folder next to it. The name of a cache entry has a
+        # key of the file (path, size, mtime) and a key of the settings the derived columns depend
+        # on, so only the entries of older versions of the file are swept.
+        if not use_cache:
+            return self._readPVTTable(filepath, hgor)
+
+        stat = os.stat(filepath)
+        file_key = hashlib.sha1(repr((os.path.abspath(filepath), stat.st_size,
+                                      stat.st_mtime_ns)).encode()).hexdigest()[:16]
+        settings_key = hashlib.sha1(repr((hgor, self.Tsp, self.Psp)).encode()).hexdigest()[:16]
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), '.pvt_cache')
+        cache_path = os.path.join(cache_dir, '%s-%s-%s' % (os.path.basename(filepath), file_key, settings_key))
+        if os.path.isdir(cache_path):
+            try:
+                return _read_columnar_cache(cache_path)
+            except OSError:
+                pass  # removed or replaced by another process meanwhile, read the workbook instead
+
+        pvt_table = self._readPVTTable(filepath, hgor)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            _write_columnar_cache(pvt_table, cache_path)
+        except OSError:
+            pass  # read-only data folder or another process wrote it first, work without the cache
+        else:
+            _remove_stale_caches(cache_dir, os.path.basename(filepath), file_key)
+        return pvt_table
+
+    def _readPVTTable(self, filepath, hgor):
         pvt_table = pd.read_excel(filepath, header=1)
+        return self._addDerivedColumns(pvt_table, hgor)
 
+    def _addDerivedColumns(self, pvt_table, hgor):
         api = pvt_table['API']
 
         if 'gas_gravity' in pvt_table.columns:
@@ -344,103 +1369,112 @@ class PVTCORR_HGOR(PVTCORR):
         pvt_table['HGOR'] = False
         pvt_table.loc[pvt_table['Rs'] > hgor, 'HGOR'] = True
 
-        self.pvt_table = pvt_table
+        return pvt_table
 
     def _computeSolutionGasOilRatio(self, api, temperature,
-                                    pressure, gas_gravity, method='vasquez_beggs_modified'):
-        if method == "vasquez_beggs_modified":
-
-            C1 = np.where(api <= 30, 1.091e+5, 3.405e+6)
-            C2 = np.where(api <= 30, 2.3913, 2.7754)
-            C3 = np.where(api <= 30, 1.e-6, 1.e-6)
-
-            a = pressure ** C3
-            b = - (C2 * api) / (temperature + 459.67)
-
-            Rs = (gas_gravity * a * (10 ** b)) / C1
-
-        elif method == "exponential_rational_8":
-            C = [9.021, -0.119, 2.221, -.531, .144, -1.842e-2, 12.802, 8.309]
-
-            a = C[0] + C[1] * np.log(temperature)
-            b = C[2] + C[3] * np.log(api)
-            d = C[6] + C[7] * np.log(gas_gravity)
-
-            K = (a / np.log(pressure) - 1.) * (b * d) ** (-1)
-
-            ln_Rs = (K - C[4]) / C[5]
-
-            Rs = np.exp(ln_Rs)
-
-        elif method == "exponential_rational_16":
-            C = [
-                7.258546e-1, -4.562008e-2,
-                3.198814e00, -3.994698e-1,
-                -1.483415e-1, 3.550853e-1,
-                2.914460e00, 4.402225e-1,
-                -1.791551e-1, 6.955443e-1,
-                -8.172007e-1, 4.229810e-1,
-                -5.612631e-1, 4.735904e-02,
-                4.746990e-02, -2.515009e-01
-            ]
-
-            C = [0.858, -7.881e-2,
-                 3.198, -.457,
-                 .146, .322,
-                 3.172, 1.015,
-                 -.34, .54,
-                 -.665, .458,
-                 -.545, 3.343e-2,
-                 .454, -.281
-                 ]
-
-            ln_t = np.log(temperature)
-            ln_api = np.log(api)
-            ln_gas_gravity = np.log(gas_gravity)
-
-            a = C[0] + C[1] * ln_t
-            e = C[8] + C[9] * ln_t
-
-            b = C[2] + C[3] * ln_api
-            f = C[10] + C[11] * ln_api
-
-            c = C[6] + C[7] * ln_gas_gravity
-            g = C[14] + C[15] * ln_gas_gravity
-
-            A = a * b * c
-            B = e * f * g
-
-            K = np.log(pressure) * B / A
-
-            ln_Rs = (K * C[12] - C[4]) / (C[5] - K * C[13])
-
-            Rs = np.exp(ln_Rs)
-
-        else:
-            raise ValueError(f'Unknown method ({method}) for calculating Rs ')
-
-        return Rs
+                                    pressure, gas_gravity, sat_pressure=None, method='vasquez_beggs_modified'):
+        Rs = self.computeSolutionGasOilRatios(api, temperature, pressure, gas_gravity,
+                                              sat_pressure=sat_pressure, methods=(method,))
+        return _squeeze(Rs[method])
+
+    def computeSolutionGasOilRatios(self, api, temperature, pressure, gas_gravity, sat_pressure=None,
+                                    methods=('vasquez_beggs_modified', 'exponential_rational_8',
+                                             'exponential_rational_16'),
+                                    out=None):
+        # Evaluates several Rs correlations on the same inputs. The log transforms of the inputs
+        # are computed once and shared by all methods, and every method writes into its row of
+        # a single (n_methods, ...) output buffer, which can be preallocated and passed as out.
+        # Returns {method: Rs array}, the arrays being views of out.
+        for method in methods:
+            if method not in RS_CORRELATIONS:
+                raise ValueError(f'Unknown method ({method}) for calculating Rs ')
+
+        if sat_pressure is not None:
+            pressure = np.minimum(pressure, sat_pressure)
+        # rows outside the domain of a correlation, or whose result overflows, are set to NaN
+        # after the batch evaluation
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            features = self._computeRsFeatures(api, temperature, pressure, gas_gravity)
+
+            if out is None:
+                out = np.empty((len(methods),) + features['ln_p'].shape)
+            for i, method in enumerate(methods):
+                _evaluate_rs_correlation(RS_CORRELATIONS[method], features, out[i, ...])
+                valid = self.rsValidityMask(method, api, temperature, pressure, gas_gravity) & np.isfinite(out[i, ...])
+                np.copyto(out[i, ...], np.nan, where=~valid)
+        return {method: out[i, ...] for i, method in enumerate(methods)}
+
+    @staticmethod
+    def rsValidityMask(method, api, temperature, pressure, gas_gravity):
+        # True where all inputs are within the registered bounds of the Rs correlation
+        inputs = {'api': api, 'temperature': temperature, 'pressure': pressure, 'gas_gravity': gas_gravity}
+        valid = True
+        for key, (lower, upper) in RS_CORRELATIONS[method]['bounds'].items():
+            valid = valid & (np.asarray(inputs[key]) > lower) & (np.asarray(inputs[key]) <= upper)
+        return np.broadcast_to(valid, np.broadcast(*inputs.values()).shape)
+
+    @staticmethod
+    def _computeRsFeatures(api, temperature, pressure, gas_gravity):
+        api, temperature, pressure, gas_gravity = np.broadcast_arrays(np.asarray(api, dtype=float),
+                                                                      np.asarray(temperature, dtype=float),
+                                                                      np.asarray(pressure, dtype=float),
+                                                                      np.asarray(gas_gravity, dtype=float))
+        features = {'api': api,
+                    'temperature': temperature,
+                    'gas_gravity': gas_gravity,
+                    'ln_t': np.log(temperature),
+                    'ln_api': np.log(api),
+                    'ln_gas_gravity': np.log(gas_gravity),
+                    'ln_p': np.log(pressure)}
+        return features
+
+    def validatePVTTable(self, pvt_table=None):
+        # Up-front check of every row of the PVT sheet (self.pvt_table by default), see
+        # _validityFlags. Returns a DataFrame aligned with the table.
+        pvt_table = self.pvt_table if pvt_table is None else pvt_table
+        flags = self._validityFlags(*(pvt_table[key].to_numpy(dtype=float)
+                                      for key in ('API', 'gamma_gs', 'temperature', 'p_sat')))
+        return pd.DataFrame(flags, index=pvt_table.index)
+
+    def _validityFlags(self, api, gas_gravity, temperature, p_sat):
+        # Vectorized over all rows: Tpr and Ppr at the saturation pressure with their range flags,
+        # the domain flag of every registered Rs correlation, and 'valid' when the inputs are
+        # finite and all flags hold (Ppr is only reported, as in the Z-factor)
+        api, gas_gravity, temperature, p_sat = np.broadcast_arrays(*(np.asarray(value, dtype=float)
+                                                                     for value in (api, gas_gravity,
+                                                                                   temperature, p_sat)))
+        Ppr, Tpr = self.computePseudoReducedProperties(p_sat, gas_gravity, temperature)
+        flags = {'Tpr': Tpr, 'Ppr': Ppr,
+                 'Tpr_valid': self.zFactorValidityMask(p_sat, gas_gravity, temperature),
+                 'Ppr_valid': (Ppr >= self.ZFACTOR_PPR_RANGE[0]) & (Ppr <= self.ZFACTOR_PPR_RANGE[1])}
+        valid = flags['Tpr_valid'] & np.isfinite(api) & np.isfinite(gas_gravity) & np.isfinite(temperature) \
+            & np.isfinite(p_sat)
+        for method in RS_CORRELATIONS:
+            flags[f'{method}_valid'] = self.rsValidityMask(method, api, temperature, p_sat, gas_gravity)
+            valid = valid & flags[f'{method}_valid']
+        flags['valid'] = valid
+        return flags
 
     def compute_RS_values(self, api, gas_gravity, temperature):
         p_sat = np.array(self.pvt_table['p_sat'])
 
         rs = np.array(self.pvt_table['Rs'])
 
-        # New correlations
-        rs_vb_mod = self._computeSolutionGasOilRatio(api, temperature, p_sat, gas_gravity,
-                                                     method='vasquez_beggs_modified')
-        rs_exp_rat_8 = self._computeSolutionGasOilRatio(api, temperature, p_sat, gas_gravity,
-                                                        method='exponential_rational_8')
-        rs_exp_rat_16 = self._computeSolutionGasOilRatio(api, temperature, p_sat, gas_gravity,
-                                                         method='exponential_rational_16')
+        return self._computeRSValues(api, gas_gravity, temperature, p_sat, rs)
 
-        comparison_dict = {'Vasquez_Beggs': []}
+    def _computeRSValues(self, api, gas_gravity, temperature, p_sat, rs):
+        # New correlations, sharing the log transforms of the inputs
+        rs_new = self.computeSolutionGasOilRatios(api, temperature, p_sat, gas_gravity,
+                                                  methods=('vasquez_beggs_modified', 'exponential_rational_8',
+                                                           'exponential_rational_16'))
+        rs_vb_mod = rs_new['vasquez_beggs_modified']
+        rs_exp_rat_8 = rs_new['exponential_rational_8']
+        rs_exp_rat_16 = rs_new['exponential_rational_16']
 
-        # Old correlations
-        for p_i, api_i, gas_gravity_i, temperature_i in zip(p_sat, api, gas_gravity, temperature):
-            self.sat_pressure = p_i
-            rs_vb = super()._computeSolutionGasOilRatio(api_i, temperature_i, p_i, gas_gravity_i)
-            comparison_dict['Vasquez_Beggs'].append(rs_vb)
+        # Old correlations, evaluated at each row's own saturation pressure
+        rs_vb = super()._computeSolutionGasOilRatio(api, temperature, p_sat, gas_gravity, sat_pressure=p_sat)
+
+        comparison_dict = {'Vasquez_Beggs': rs_vb}
 
         comparison_dict['pressure'] = p_sat
         comparison_dict['temperature'] = temperature
@@ -450,5 +1484,52 @@ class PVTCORR_HGOR(PVTCORR):
         comparison_dict['Vasquez_Beggs_modified'] = rs_vb_mod
         comparison_dict['Exponential_Rational_8'] = rs_exp_rat_8
         comparison_dict['Exponential_Rational_16'] = rs_exp_rat_16
+        comparison_dict['valid'] = _squeeze(self._validityFlags(api, gas_gravity, temperature, p_sat)['valid'])
 
         return comparison_dict
+
+    def iter_RS_values(self, source, chunksize=100000):
+        # Streams compute_RS_values over a table too large to hold in memory.
+        # source: CSV or Parquet path, a DataFrame, or an iterable of DataFrames, with the
+        # same columns as the PVT sheet (API, temperature, p_sat, Rs and gamma_gs or gas_gravity).
+        # Yields one result DataFrame (columns of compute_RS_values plus HGOR) per chunk.
+        for chunk in _iter_table_chunks(source, chunksize):
+            chunk = self._addDerivedColumns(chunk.reset_index(drop=True), self.hgor)
+            comparison_dict = self._computeRSValues(chunk['API'].to_numpy(dtype=float),
+                                                    chunk['gamma_gs'].to_numpy(dtype=float),
+                                                    chunk['temperature'].to_numpy(dtype=float),
+                                                    chunk['p_sat'].to_numpy(dtype=float),
+                                                    chunk['Rs'].to_numpy(dtype=float))
+            df_Rs = pd.DataFrame(comparison_dict)
+            df_Rs['HGOR'] = chunk['HGOR'].to_numpy()
+            yield df_Rs
+
+    def stream_RS_values(self, source, output=None, chunksize=100000):
+        # Runs iter_RS_values chunk by chunk, appending the results to output (.csv or .parquet)
+        # when given, and accumulates ADE, LSE and AARE (see utils.metrics) of every correlation
+        # against the measured Rs without keeping the results in memory.
+        # Returns the metrics as a DataFrame indexed by correlation.
+        sums = {method: np.zeros(4) for method in self.RS_METHODS}
+        writer = None
+        try:
+            for i_chunk, df_Rs in enumerate(self.iter_RS_values(source, chunksize=chunksize)):
+                if output is not None:
+                    writer = _append_table_chunk(df_Rs, output, writer, first=i_chunk == 0)
+
+                measured = df_Rs['Rs'].to_numpy()
+                for method in self.RS_METHODS:
+                    calculated = df_Rs[method].to_numpy(dtype=float)
+                    ln_error = np.log(measured) - np.log(calculated)
+                    valid = np.isfinite(ln_error)
+                    sums[method] += [valid.sum(),
+                                     np.sum(np.abs(ln_error[valid])),
+                                     np.sum(ln_error[valid] ** 2),
+                                     np.sum(np.abs((measured[valid] - calculated[valid]) / calculated[valid]))]
+        finally:
+            if writer is not None:
+                writer.close()
+
+        metrics = {method: {'n_samples': int(n), 'ADE': ade, 'LSE': lse,
+                            'AARE': aare * 100 / n if n else np.nan}
+                   for method, (n, ade, lse, aare) in sums.items()}
+        return pd.DataFrame.from_dict(metrics, orient='index')
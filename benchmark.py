@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from LGOR_script import PVTCORR, PVTCORR_HGOR
+from utils import Grace
+
+# Benchmarks of the PVT correlations, the Z-factor, the PVT matching and ACE on synthetic fluids,
+# so no private data is needed. Every case reports throughput (points/s), latency percentiles and
+# peak memory; results can be stored as a baseline and later runs are flagged when their
+# throughput drops below it.
+#   python benchmark.py                    run and compare against benchmark_baseline.json
+#   python benchmark.py --save-baseline    run and store the results as the new baseline
+
+BASELINE_PATH = 'benchmark_baseline.json'
+
+# ranges of the synthetic fluids: with 0.6 <= gas gravity <= 1.0 and 100 <= T <= 300 F the pseudo
+# reduced temperature stays between 1.26 and 2.16, inside the 1 <= Tpr <= 3 of Dranchuk-Abou-Kassem
+FLUID_RANGES = {'api': (15., 55.), 'gas_gravity': (0.6, 1.0), 'temperature': (100., 300.),
+                'pressure': (200., 6000.), 'p_sat': (500., 5000.)}
+
+
+def synthetic_fluids(n, seed=0):
+    # n random fluids, uniform within FLUID_RANGES
+    rng = np.random.default_rng(seed)
+    fluids = {key: rng.uniform(low, high, n) for key, (low, high) in FLUID_RANGES.items()}
+    fluids['Rs'] = PVTCORR(sat_pressure=None, Tsp=60, Psp=500)._computeSolutionGasOilRatio(
+        fluids['api'], fluids['temperature'], fluids['p_sat'], fluids['gas_gravity'], sat_pressure=fluids['p_sat'])
+    fluids['Rs'] = fluids['Rs'] * rng.lognormal(0., 0.1, n)
+    return pd.DataFrame(fluids)
+
+
+def synthetic_pvt_table(pvtcorr, api=35., gas_gravity=0.75, temperature=200., n_steps=12):
+    # measured table of a single fluid, as matched by PVTCORR.match_PVT_values
+    pressure = np.linspace(500., 5000., n_steps)
+    table = pd.DataFrame(pvtcorr.computePVTProperties(api, gas_gravity, temperature, pressure))
+    table.insert(0, 'p', pressure)
+    return table
+
+
+def synthetic_rs_table(n, seed=0):
+    # PVTCORR_HGOR reads its table from an Excel sheet (header on the second row); without the
+    # cache the sheet is fully loaded, so the temporary folder can go once the instance is built
+    df = synthetic_fluids(n, seed=seed)
+    df = df.rename(columns={'api': 'API', 'gas_gravity': 'gamma_gs'})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'synthetic_pvt.xlsx')
+        df.to_excel(path, startrow=1, index=False)
+        return PVTCORR_HGOR(sat_pressure=None, Tsp=60, Psp=500, filepath=path, use_cache=False)
+
+
+def measure(func, n_points, repeats=5):
+    # latencies of repeated calls, then one more call under tracemalloc for the peak memory
+    func()  # warm up
+    latencies = np.empty(repeats)
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies[i] = time.perf_counter() - start
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {'n_points': n_points,
+            'throughput': n_points / p50,
+            'p50_ms': p50 * 1e3,
+            'p90_ms': p90 * 1e3,
+            'p99_ms': p99 * 1e3,
+            'peak_mb': peak / 2 ** 20}
+
+
+def zfactor_cases(sizes, scalar_limit):
+    pvtcorr = PVTCORR(sat_pressure=2500., Tsp=60, Psp=500)
+    for n in sizes:
+        fluids = synthetic_fluids(n)
+        p, g, t = (fluids[key].to_numpy() for key in ('pressure', 'gas_gravity', 'temperature'))
+        yield 'zfactor_batched', n, lambda: pvtcorr.computeDryGasZFactor(p, g, t)
+        if n <= scalar_limit:
+            yield 'zfactor_scalar', n, lambda: [pvtcorr.computeDryGasZFactor(*args) for args in zip(p, g, t)]
+
+
+def pvt_properties_cases(sizes, scalar_limit):
+    pvtcorr = PVTCORR(sat_pressure=2500., Tsp=60, Psp=500)
+    for n in sizes:
+        fluids = synthetic_fluids(n)
+        a, g, t, p, ps = (fluids[key].to_numpy() for key in ('api', 'gas_gravity', 'temperature', 'pressure',
+                                                            'p_sat'))
+        yield 'pvt_properties_batched', n, lambda: pvtcorr.computePVTProperties(a, g, t, p, sat_pressure=ps)
+        if n <= scalar_limit:
+            yield 'pvt_properties_scalar', n, lambda: [pvtcorr.computePVTProperties(*args)
+                                                       for args in zip(a, g, t, p, ps)]
+
+
+def rs_values_cases(sizes, scalar_limit):
+    for n in sizes:
+        pvtc = synthetic_rs_table(n)
+        table = pvtc.pvt_table
+        api, g, t, ps, rs = (table[key].to_numpy() for key in ('API', 'gamma_gs', 'temperature', 'p_sat', 'Rs'))
+        yield 'rs_values_batched', n, lambda: pvtc.compute_RS_values(api, g, t)
+        if n <= scalar_limit:
+            yield 'rs_values_scalar', n, lambda: [pvtc._computeRSValues(*args) for args in zip(api, g, t, ps, rs)]
+
+
+def matching_cases(n_steps=12):
+    range_of_values = [FLUID_RANGES['api'], FLUID_RANGES['gas_gravity'], FLUID_RANGES['temperature']]
+    pvtcorr = PVTCORR(sat_pressure=2500., Tsp=60, Psp=500)
+    pvtcorr.pvt_table = synthetic_pvt_table(pvtcorr, n_steps=n_steps)
+    yield 'matching_de', n_steps, lambda: pvtcorr.match_PVT_values(range_of_values)
+    yield 'matching_de_vectorized', n_steps, lambda: pvtcorr.match_PVT_values(range_of_values, vectorized=True)
+    yield 'matching_hybrid', n_steps, lambda: pvtcorr.match_PVT_values(range_of_values, method='hybrid')
+
+
+def ace_cases(sizes, lowess_limit):
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        x = rng.uniform(0., 1., n)
+        y = np.exp(x) + 0.1 * rng.normal(size=n)
+        for backend in Grace.SMOOTHERS:
+            if backend == 'lowess' and n > lowess_limit:
+                continue
+            grace = Grace(backend=backend)
+            grace.span = 0.2
+            yield f'ace_{backend}', n, lambda: grace.finite_ace(x, y)
+
+
+def run(sizes=(100, 1000, 10000, 100000), repeats=5, scalar_limit=1000, lowess_limit=1000, matching=True):
+    # Returns the results as a DataFrame indexed by (case, n_points)
+    cases = [zfactor_cases(sizes, scalar_limit),
+             pvt_properties_cases(sizes, scalar_limit),
+             rs_values_cases(sizes, scalar_limit),
+             ace_cases(sizes, lowess_limit)]
+    if matching:
+        cases.append(matching_cases())
+
+    results = []
+    for generator in cases:
+        for name, n, func in generator:
+            # the slow cases (matching, scalar loops) are repeated less
+            n_repeats = repeats if not (name.startswith('matching') or name.endswith('scalar')) else 3
+            result = measure(func, n, repeats=n_repeats)
+            result['case'] = name
+            results.append(result)
+            print(f"{name:>26} n={n:<7d} {result['throughput']:12.0f} pts/s  p50 {result['p50_ms']:10.2f} ms  "
+                  f"peak {result['peak_mb']:8.1f} MB")
+    return pd.DataFrame(results).set_index(['case', 'n_points'])
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    baseline = {f'{case}[{n}]': row.to_dict() for (case, n), row in results.iterrows()}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+
+
+def compare_baseline(results, path=BASELINE_PATH, tolerance=0.2):
+    # ratio of the throughput to the baseline; cases more than tolerance slower are flagged
+    with open(path) as f:
+        baseline = json.load(f)
+    rows = []
+    for (case, n), row in results.iterrows():
+        reference = baseline.get(f'{case}[{n}]')
+        if reference is None:
+            continue
+        ratio = row['throughput'] / reference['throughput']
+        rows.append({'case': case, 'n_points': n, 'ratio': ratio,
+                     'peak_mb_change': row['peak_mb'] - reference['peak_mb'],
+                     'regression': ratio < 1. - tolerance})
+    return pd.DataFrame(rows, columns=['case', 'n_points', 'ratio', 'peak_mb_change', 'regression'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the PVT correlations, matching and ACE')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--no-matching', action='store_true')
+    args = parser.parse_args()
+
+    results = run(sizes=args.sizes, repeats=args.repeats, matching=not args.no_matching)
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f'Baseline saved to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        comparison = compare_baseline(results, args.baseline, tolerance=args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison['regression'].any():
+            raise SystemExit('Throughput regressions against the baseline')
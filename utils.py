@@ -6,9 +6,11 @@ import plotly.express as px
 import matplotlib.pyplot as plt
 import pandas as pd
 import os
+import time
 import seaborn as sns
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
 
 def plot_log_log(df, measured, calculated, title):
@@ -70,24 +72,193 @@ def plot_pairplots(df, hue='', origin='xom'):
 
 
 def metrics(measured, calculated):
+    # calculated may be a matrix with one correlation per column, the metrics are then arrays
+    measured = np.asarray(measured, dtype=float)
+    calculated = np.asarray(calculated, dtype=float)
+    if calculated.ndim == 2:
+        measured = measured.reshape(-1, 1)
+
     ln_measured = np.log(measured)
     ln_calculated = np.log(calculated)
 
     n_samples = measured.shape[0]
 
-    ADE = np.sum(np.abs(ln_measured - ln_calculated))
-    LSE = np.sum(np.power(ln_measured - ln_calculated), 2)
-    AARE = np.sum(np.abs((measured - calculated) / calculated)) * 100 / n_samples
+    ADE = np.sum(np.abs(ln_measured - ln_calculated), axis=0)
+    LSE = np.sum(np.power(ln_measured - ln_calculated, 2), axis=0)
+    AARE = np.sum(np.abs((measured - calculated) / calculated), axis=0) * 100 / n_samples
 
     metrics = {'ADE': ADE, 'LSE': LSE, 'AARE': AARE}
 
     return metrics
 
 
+METRICS = ('ADE', 'LSE', 'AARE')
+
+
+def _metric_terms(measured, calculated):
+    # Per sample terms of the metrics for every column of calculated, shape (n, 4 * m) laid out
+    # as [valid | ADE | LSE | AARE] blocks of m columns. Samples whose log error is not finite
+    # (non-positive or missing values) are left out, as in PVTCORR_HGOR.stream_RS_values.
+    measured = np.asarray(measured, dtype=float).reshape(-1, 1)
+    calculated = np.asarray(calculated, dtype=float)
+    if calculated.ndim == 1:
+        calculated = calculated.reshape(-1, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ln_error = np.log(measured) - np.log(calculated)
+        relative_error = np.abs((measured - calculated) / calculated)
+    valid = np.isfinite(ln_error) & np.isfinite(relative_error)
+
+    terms = np.zeros((calculated.shape[0], 4 * calculated.shape[1]))
+    blocks = np.split(terms, 4, axis=1)
+    blocks[0][valid] = 1.
+    np.abs(ln_error, out=blocks[1], where=valid)
+    np.square(ln_error, out=blocks[2], where=valid)
+    np.copyto(blocks[3], relative_error, where=valid)
+    return terms
+
+
+def _metrics_from_sums(sums):
+    # ADE, LSE and AARE from the column sums of _metric_terms, along the last axis
+    n_samples, ade, lse, aare = np.split(sums, 4, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aare = aare * 100 / n_samples
+    return n_samples, {'ADE': ade, 'LSE': lse, 'AARE': aare}
+
+
+def _groups(df, by):
+    # (label, row mask) of every group of df[by], or the whole table when by is None
+    if by is None:
+        return [(None, np.ones(len(df), dtype=bool))]
+    values = df[by].to_numpy()
+    return [(value, values == value) for value in pd.unique(values)]
+
+
+def metrics_table(df, calculated, measured='Rs', by=None):
+    # ADE, LSE and AARE of every correlation column in calculated against measured, all scored
+    # in one matrix operation. by: column to split the scores on (e.g. 'HGOR').
+    # Returns a DataFrame indexed by correlation (by value and correlation when by is given).
+    calculated = list(calculated)
+    terms = _metric_terms(df[measured].to_numpy(dtype=float), df[calculated].to_numpy(dtype=float))
+
+    tables = []
+    for label, rows in _groups(df, by):
+        n_samples, scores = _metrics_from_sums(terms[rows].sum(axis=0))
+        table = pd.DataFrame({'n_samples': n_samples.astype(int), **scores}, index=calculated)
+        if by is not None:
+            table.index = pd.MultiIndex.from_product([[label], calculated], names=[by, 'correlation'])
+        tables.append(table)
+    return pd.concat(tables)
+
+
+def bootstrap_metrics(df, calculated, measured='Rs', by=None, n_boot=2000, confidence=0.95, seed=0,
+                      chunk_size=2 ** 22):
+    # Bootstrap confidence intervals of metrics_table. Every resample is drawn as an array of
+    # row indices and turned into row counts, so the metrics of a batch of resamples are a single
+    # (n_resamples, n) @ (n, 4 * m) product; batches hold about chunk_size counts.
+    # Returns metrics_table with the columns <metric>_low and <metric>_high added.
+    calculated = list(calculated)
+    terms = _metric_terms(df[measured].to_numpy(dtype=float), df[calculated].to_numpy(dtype=float))
+    rng = np.random.default_rng(seed)
+    q = [(1. - confidence) / 2., (1. + confidence) / 2.]
+
+    table = metrics_table(df, calculated, measured=measured, by=by)
+    for row, (label, rows) in enumerate(_groups(df, by)):
+        group_terms = terms[rows]
+        n = group_terms.shape[0]
+        batch = max(1, chunk_size // max(n, 1))
+
+        sums = np.empty((n_boot, group_terms.shape[1]))
+        for start in range(0, n_boot, batch):
+            b = min(batch, n_boot - start)
+            idx = rng.integers(0, n, size=(b, n)) + n * np.arange(b)[:, np.newaxis]
+            counts = np.bincount(idx.ravel(), minlength=b * n).reshape(b, n)
+            sums[start:start + b] = counts @ group_terms
+
+        _, scores = _metrics_from_sums(sums)
+        table_rows = slice(row * len(calculated), (row + 1) * len(calculated))
+        for name in METRICS:
+            low, high = np.nanquantile(scores[name], q, axis=0)
+            table.loc[table.index[table_rows], f'{name}_low'] = low
+            table.loc[table.index[table_rows], f'{name}_high'] = high
+    return table
+
+
+def _running_lines(xs, ys, k):
+    # Running lines smoother on data sorted by xs: a least squares line through the window of
+    # k consecutive points centred (as far as the ends allow) on every point, using updating
+    # (cumulative) sums, so O(n) after the sort. Returns the fit and the hat matrix diagonal.
+    n = xs.shape[0]
+    k = min(max(k, 2), n)
+    start = np.clip(np.arange(n) - k // 2, 0, n - k)
+    end = start + k
+
+    xc = xs - np.mean(xs)  # centred for accuracy of the sums
+    sums = [np.concatenate([[0.], np.cumsum(v)]) for v in (xc, ys, xc * xc, xc * ys)]
+    sx, sy, sxx, sxy = [c[end] - c[start] for c in sums]
+
+    x_mean = sx / k
+    y_mean = sy / k
+    var_x = sxx - k * x_mean ** 2
+    cov_xy = sxy - k * x_mean * y_mean
+    flat = var_x <= 1e-12 * np.maximum(sxx, 1e-300)
+    slope = np.where(flat, 0., cov_xy / np.where(flat, 1., var_x))
+
+    fit = y_mean + slope * (xc - x_mean)
+    hat = 1. / k + np.where(flat, 0., (xc - x_mean) ** 2 / np.where(flat, 1., var_x))
+    return fit, hat
+
+
+def _supersmoother(xs, ys, spans=(0.05, 0.2, 0.5)):
+    # Friedman's (1984) supersmoother on sorted data: running lines fits with the tweeter,
+    # midrange and woofer spans, a local choice of span from the smoothed leave-one-out
+    # residuals, and a final smooth with the tweeter span
+    n = xs.shape[0]
+    spans = np.asarray(spans, dtype=float)
+    k_mid = int(spans[1] * n)
+
+    fits = np.empty((spans.size, n))
+    cv_residuals = np.empty((spans.size, n))
+    for j, span in enumerate(spans):
+        fit, hat = _running_lines(xs, ys, int(span * n))
+        fits[j] = fit
+        residual = np.abs(ys - fit) / np.maximum(1. - hat, 1e-12)
+        cv_residuals[j] = _running_lines(xs, residual, k_mid)[0]
+
+    best_span = spans[np.argmin(cv_residuals, axis=0)]
+    best_span = np.clip(_running_lines(xs, best_span, k_mid)[0], spans[0], spans[-1])
+
+    # interpolate between the two fits whose spans bracket the chosen span
+    j = np.clip(np.searchsorted(spans, best_span) - 1, 0, spans.size - 2)
+    weight = (best_span - spans[j]) / (spans[j + 1] - spans[j])
+    i = np.arange(n)
+    fit = (1. - weight) * fits[j, i] + weight * fits[j + 1, i]
+    return _running_lines(xs, fit, int(spans[0] * n))[0]
+
+
+def _cv_error_worker(args):
+    # worker of Grace.crossValidation, kept at module level so it can be pickled
+    grace, x, y, span, method, n_folds, seed = args
+    return grace._cvError(x, y, span, method=method, n_folds=n_folds, seed=seed)
+
+
 class Grace:
-    def __init__(self):
+    # backend of smoother: 'lowess' (statsmodels), 'running_lines' (O(n) updating sums) or
+    # 'supersmoother' (Friedman, chooses its own span locally).
+    # lowess_iterations: robustifying iterations of lowess (statsmodels' it); the fast cross
+    # validation ('loo', 'gcv') needs the linear lowess, lowess_iterations=0
+    SMOOTHERS = ('lowess', 'running_lines', 'supersmoother')
+
+    def __init__(self, backend='lowess', lowess_iterations=3):
+        if backend not in self.SMOOTHERS:
+            raise ValueError(f'Unknown smoother ({backend})')
         self.tol = 1e-8
+        self.max_iter = 100
         self._span = None
+        self.cv_spans = None
+        self.ace_history = None
+        self.backend = backend
+        self.lowess_iterations = lowess_iterations
 
     @property
     def span(self):
@@ -98,25 +269,52 @@ class Grace:
         self._span = value
 
     def finite_ace(self, x, y):
+        # x and y are sorted once and the smoother works on the sorted copies; phi_x, theta_y
+        # and the errors live in buffers allocated before the loop and updated in place, so the
+        # memory is O(n). The elapsed time, delta and mean squared error of every iteration are
+        # kept in self.ace_history.
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
         x = (x - np.mean(x)) / np.std(x)
         y = (y - np.mean(y)) / np.std(y)
+        n = x.shape[0]
+
+        order_x = np.argsort(x, kind='stable')
+        order_y = np.argsort(y, kind='stable')
+        xs = x[order_x]
+        ys = y[order_y]
 
+        phi_x = np.empty(n)
         theta_y = y / np.linalg.norm(y, 2)
+        sorted_buffer = np.empty(n)
+        error = np.empty(n)
+        error0 = np.ones(n)
+
+        history = {'time': [], 'delta': [], 'error': []}
+        start = time.perf_counter()
 
-        phi_x = 0.
         delta = 1
-        error0 = np.ones((x.shape[0], 1))
         count = 1
         tol = self.tol
         while delta > tol:
-            phi_x = self.smoother(x=x, y=theta_y, span=self.span)
-            theta_y = self.smoother(x=y, y=phi_x, span=self.span)
+            np.take(theta_y, order_x, out=sorted_buffer)
+            phi_x[order_x] = self._smoothSorted(xs, sorted_buffer, self.span)
+            np.take(phi_x, order_y, out=sorted_buffer)
+            theta_y[order_y] = self._smoothSorted(ys, sorted_buffer, self.span)
 
-            theta_y = (theta_y - np.mean(theta_y)) / np.linalg.norm(theta_y, 2)
+            theta_y -= np.mean(theta_y)
+            theta_y /= np.linalg.norm(theta_y, 2)
 
-            error = (theta_y - phi_x) ** 2
-            delta = np.linalg.norm(error - error0, 2)
-            error0 = error
+            np.subtract(theta_y, phi_x, out=error)
+            np.square(error, out=error)
+            # error0 becomes the difference, then the buffers swap roles for the next iteration
+            error0 -= error
+            delta = np.linalg.norm(error0, 2)
+            error, error0 = error0, error
+
+            history['time'].append(time.perf_counter() - start)
+            history['delta'].append(delta)
+            history['error'].append(np.mean(error0))
 
             if count > 50:
                 tol = tol * 10
@@ -124,14 +322,94 @@ class Grace:
             else:
                 count += 1
 
+        self.ace_history = {key: np.asarray(value) for key, value in history.items()}
+
         return phi_x, theta_y
 
-    @staticmethod
-    def smoother(x, y, span):
+    def multivariate_ace(self, x, y, max_iter=None):
+        # ACE with several predictors (columns of x, e.g. p_sat, temperature, API and gamma_gs):
+        # every outer iteration backfits the transform of each predictor against the partial
+        # residual of the others, then smooths theta_y against their sum. Stops when the change
+        # of the mean squared error falls below tol or after max_iter iterations.
+        # Returns phi_x (n, p) and theta_y (n,); Grace.linearRegression(phi_x, theta_y) gives
+        # the weights of the transforms.
+        max_iter = self.max_iter if max_iter is None else max_iter
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if x.ndim == 1:
+            x = x[:, np.newaxis]
+        n, p = x.shape
+
+        x = (x - np.mean(x, axis=0)) / np.std(x, axis=0)
+        y = (y - np.mean(y)) / np.std(y)
+
+        theta_y = y / np.linalg.norm(y, 2)
+
+        # the data never changes between iterations, so every column is sorted only once
+        order_x = np.argsort(x, axis=0, kind='stable')
+        order_y = np.argsort(y, kind='stable')
+
+        phi_x = np.zeros((n, p))
+        phi_sum = np.zeros(n)
+        error0 = np.inf
+        for _ in range(max_iter):
+            for j in range(p):
+                # partial residual of predictor j, keeping the running sum of the transforms
+                phi_sum -= phi_x[:, j]
+                phi_j = self.smoother(x=x[:, j], y=theta_y - phi_sum, span=self.span, order=order_x[:, j])
+                phi_x[:, j] = phi_j - np.mean(phi_j)
+                phi_sum += phi_x[:, j]
+
+            theta_y = self.smoother(x=y, y=phi_sum, span=self.span, order=order_y)
+            theta_y = (theta_y - np.mean(theta_y)) / np.linalg.norm(theta_y, 2)
+
+            error = np.mean((theta_y - phi_sum) ** 2)
+            if abs(error0 - error) <= self.tol * max(error, 1e-300):
+                break
+            error0 = error
+
+        return phi_x, theta_y
+
+    def smoother(self, x, y, span, order=None):
+        # order: precomputed argsort of x, reused by callers that smooth against the same x
         # s = savgol_filter(x, window_length=span, polyorder=polyorder)
-        s_ = lowess(endog=y, exog=x, frac=span, return_sorted=False)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if order is None:
+            order = np.argsort(x, kind='stable')
+
+        s_ = np.empty(x.shape[0])
+        s_[order] = self._smoothSorted(x[order], y[order], span)
         return s_
 
+    def _smoothSorted(self, xs, ys, span):
+        # smoother backend on data already sorted by xs, returns the fit in sorted order
+        if self.backend == 'lowess':
+            return lowess(endog=ys, exog=xs, frac=span, it=self.lowess_iterations, is_sorted=True,
+                          return_sorted=False)
+        if self.backend == 'running_lines':
+            return _running_lines(xs, ys, int(span * xs.shape[0]))[0]
+        return _supersmoother(xs, ys)
+
+    def smootherHat(self, x, y, span):
+        # fit and hat matrix diagonal of the linear smoothers, for the fast cross validation
+        if self.backend == 'lowess':
+            if self.lowess_iterations != 0:
+                raise ValueError('The robust lowess (lowess_iterations > 0) is not linear, use '
+                                 'lowess_iterations=0 or method="exact" or "kfold"')
+            return self.lowessHat(x, y, span)
+        if self.backend == 'running_lines':
+            x = np.asarray(x, dtype=float)
+            order = np.argsort(x, kind='stable')
+            fit_sorted, hat_sorted = _running_lines(x[order], np.asarray(y, dtype=float)[order],
+                                                    int(span * x.shape[0]))
+            fit = np.empty_like(fit_sorted)
+            hat = np.empty_like(hat_sorted)
+            fit[order] = fit_sorted
+            hat[order] = hat_sorted
+            return fit, hat
+        raise ValueError(f'The {self.backend} smoother is not linear and chooses its own span')
+
     @staticmethod
     def linearRegression(phi_x, theta_y):
         # linear regression
@@ -161,26 +439,141 @@ class Grace:
     def plot_cv_span():
         a = 0
 
-    def crossValidation(self, x, y, n_spans=50):
+    @staticmethod
+    def lowessHat(x, y, span, chunk_size=2 ** 22):
+        # Linear (it=0) lowess fit together with the diagonal of its hat matrix, so that the
+        # leave-one-out residuals are (y - fit) / (1 - hat) without refitting. Reproduces
+        # statsmodels lowess(it=0): k = int(span * n) nearest neighbours, tricube weights and a
+        # local linear fit. Neighbourhoods are evaluated in chunks of about chunk_size entries.
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        n = x.shape[0]
+        k = min(max(int(span * n + 1e-10), 2), n)
+
+        order = np.argsort(x, kind='stable')
+        xs = x[order]
+        ys = y[order]
+
+        # left end of the k nearest neighbours of every point (binary search over all points):
+        # the window [lo, lo + k) moves right while x_i > (x[lo] + x[lo + k]) / 2
+        lo = np.zeros(n, dtype=int)
+        hi = np.full(n, n - k)
+        while np.any(lo < hi):
+            mid = (lo + hi) // 2
+            move = xs - xs[mid] > xs[np.minimum(mid + k, n - 1)] - xs
+            lo = np.where(move & (lo < hi), mid + 1, lo)
+            hi = np.where(~move & (lo < hi), mid, hi)
+
+        fit = np.empty(n)
+        hat = np.empty(n)
+        offsets = np.arange(k)
+        rows = max(1, chunk_size // k)
+        for start in range(0, n, rows):
+            i = np.arange(start, min(start + rows, n))
+            idx = lo[i, np.newaxis] + offsets
+            xj = xs[idx]
+            xi = xs[i, np.newaxis]
+            radius = np.maximum(xi - xs[lo[i], np.newaxis], xs[lo[i] + k - 1, np.newaxis] - xi)
+            w = (1. - (np.abs(xj - xi) / radius) ** 3) ** 3
+            sum_w = w.sum(axis=1, keepdims=True)
+            # lowess returns y itself when fewer than two neighbours have weight
+            reg_ok = (w > 1e-12).sum(axis=1) >= 2
+            w /= sum_w
+            xbar = np.sum(w * xj, axis=1, keepdims=True)
+            ssd = np.maximum(np.sum(w * (xj - xbar) ** 2, axis=1, keepdims=True), 1e-12)
+            p = w * (1. + (xi - xbar) * (xj - xbar) / ssd)
+            fit[i] = np.where(reg_ok, np.sum(p * ys[idx], axis=1), ys[i])
+            hat[i] = np.where(reg_ok, (1. + (xi - xbar) ** 2 / ssd)[:, 0] / sum_w[:, 0], 1.)
+
+        fit[order] = fit.copy()
+        hat[order] = hat.copy()
+        return fit, hat
+
+    def _cvError(self, x, y, span, method='exact', n_folds=10, seed=0):
         n_samples = x.shape[0]
 
-        k_test = np.linspace(0.01, 1., num=n_spans)
-
-        cv_error = np.zeros((n_spans, 1))
-        for i_k, k in enumerate(k_test):
+        if method == 'exact':
             y_pred = np.zeros(x.shape)
-            for i in tqdm(range(n_samples), desc=f"Testing span {i_k + 1}/{n_spans}"):
+            for i in tqdm(range(n_samples), desc=f"Testing span {span:.3f}"):
                 # excluding i
                 x_test = np.delete(x, i, axis=0)
                 y_test = np.delete(y, i, axis=0)
 
                 # smoothing the remaining
-                s = self.smoother(x_test, y_test, span=k)
+                s = self.smoother(x_test, y_test, span=span)
 
                 # predicting x_i by linear interpolation
                 y_pred[i] = np.interp(x[i], x_test, s)
 
-            cv_error[i_k] = np.sum((y - y_pred) ** 2) / n_samples
+            return np.sum((y - y_pred) ** 2) / n_samples
+
+        if method in ('loo', 'gcv'):
+            fit, hat = self.smootherHat(x, y, span)
+            if method == 'loo':
+                # a point fitted by itself (hat = 1) has no leave-one-out prediction
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    loo_residuals = np.where(hat < 1., (y - fit) / (1. - hat), np.nan)
+                return np.nanmean(loo_residuals ** 2)
+            return np.mean((y - fit) ** 2) / (1. - np.mean(hat)) ** 2
+
+        if method == 'kfold':
+            folds = np.random.default_rng(seed).permutation(n_samples) % n_folds
+            sse = 0.
+            for fold in range(n_folds):
+                test = folds == fold
+                if self.backend == 'lowess':
+                    y_pred = lowess(endog=y[~test], exog=x[~test], frac=span, it=self.lowess_iterations,
+                                    xvals=x[test])
+                else:
+                    # predicting the test points by linear interpolation of the smoothed training data
+                    order = np.argsort(x[~test], kind='stable')
+                    s = self.smoother(x[~test], y[~test], span=span, order=order)
+                    y_pred = np.interp(x[test], x[~test][order], s[order])
+                sse += np.nansum((y[test] - y_pred) ** 2)
+            return sse / n_samples
+
+        raise ValueError(f'Unknown cross validation method ({method})')
+
+    def _cvErrors(self, x, y, spans, method, n_folds, seed, n_jobs):
+        # cross validation error of every span, in the order of spans
+        if n_jobs == 1:
+            return [self._cvError(x, y, k, method=method, n_folds=n_folds, seed=seed) for k in spans]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(_cv_error_worker,
+                                     [(self, x, y, k, method, n_folds, seed) for k in spans]))
+
+    def crossValidation(self, x, y, n_spans=50, method='exact', n_folds=10, seed=0, n_jobs=1, refine=0):
+        # method: 'exact' refits lowess for every left out sample (n fits per span);
+        # 'loo' gets the leave-one-out residuals of the linear lowess (lowess_iterations=0) from
+        # the diagonal of its hat matrix, 'gcv' is the generalized cross validation approximation
+        # of it, both at the cost of a single fit per span; 'kfold' refits once per fold.
+        # n_jobs: spans evaluated in parallel by a process pool (None uses all cores).
+        # refine: number of coarse-to-fine rounds; each one evaluates n_spans new spans between
+        # the neighbours of the current best span, so a small coarse n_spans is enough.
+        # Returns the cv error of every evaluated span in increasing span order; the spans are
+        # kept in self.cv_spans.
+        if self.backend == 'supersmoother':
+            raise ValueError('The supersmoother chooses its own span, there is no span to cross validate')
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        k_test = np.linspace(0.01, 1., num=n_spans)
+        errors = self._cvErrors(x, y, k_test, method, n_folds, seed, n_jobs)
+
+        for _ in range(refine):
+            i_min = np.argmin(errors)
+            lower = k_test[max(i_min - 1, 0)]
+            upper = k_test[min(i_min + 1, len(k_test) - 1)]
+            k_new = np.setdiff1d(np.linspace(lower, upper, num=n_spans + 2)[1:-1], k_test)
+            errors_new = self._cvErrors(x, y, k_new, method, n_folds, seed, n_jobs)
+            k_test = np.concatenate([k_test, k_new])
+            errors = np.concatenate([errors, errors_new])
+            order = np.argsort(k_test, kind='stable')
+            k_test = k_test[order]
+            errors = errors[order]
+
+        cv_error = np.asarray(errors, dtype=float).reshape(-1, 1)
+        self.cv_spans = k_test
 
         min_cv = np.argmin(cv_error)
         best_span = k_test[min_cv]